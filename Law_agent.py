@@ -2,37 +2,115 @@ from __future__ import annotations as _annotations
 
 import asyncio
 import os
+import time
 import httpx
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import Any, List, Dict
+from functools import cached_property
+from typing import Any, AsyncIterator, List, Dict
 from pathlib import Path
-from dotenv import load_dotenv
-from devtools import debug
 from pydantic_ai import Agent, RunContext
-from pydantic_ai.models.openai import OpenAIChatModel
-from pydantic_ai.providers.openrouter import OpenRouterProvider
+from pydantic_ai.exceptions import ModelHTTPError
+from pydantic_ai.models import Model, StreamedResponse
+from pydantic_ai.models.wrapper import WrapperModel
+
+from Law_agent_cache import SimilarityCache, SingleFlight, canonicalize_arabic
+from Law_agent_config import load_env
+from Law_agent_metrics import EXPERT_REQUEST_SECONDS, LLM_REQUEST_SECONDS, UPSTREAM_RESPONSES, record_cache_lookup
+from Law_agent_tracing import tracer
 
 # --- Configuration ---
 # Load environment variables from .env file
-load_dotenv()
+load_env()
 
 # Best Practice: Use a specific, fast model. gpt-4o-mini is a good choice.
 # For even faster responses, you could explore smaller models if they meet your accuracy needs.
 LLM_MODEL = os.getenv('LLM_MODEL', 'openai/gpt-4o-mini')
 OPEN_ROUTER_API_KEY = os.getenv('OPEN_ROUTER_API_KEY')
+EXPERT_API_URL = os.getenv('EXPERT_API_URL', 'https://n8n-lightrag.dfngk5.easypanel.host/query')
+
+# Connection pool settings for the shared client used by the `expert` tool.
+EXPERT_HTTP_MAX_CONNECTIONS = int(os.getenv('EXPERT_HTTP_MAX_CONNECTIONS', '100'))
+EXPERT_HTTP_MAX_KEEPALIVE = int(os.getenv('EXPERT_HTTP_MAX_KEEPALIVE', '20'))
+EXPERT_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('EXPERT_HTTP_KEEPALIVE_EXPIRY', '30'))
+EXPERT_HTTP2 = os.getenv('EXPERT_HTTP2', 'false').lower() in ('1', 'true', 'yes')
+
+# Result cache for the `expert` tool (set EXPERT_CACHE_MAX_BYTES=0 to disable).
+EXPERT_CACHE_MAX_BYTES = int(os.getenv('EXPERT_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+EXPERT_CACHE_TTL = float(os.getenv('EXPERT_CACHE_TTL', '3600'))
+# Minimum Jaccard similarity, over the character shingles of the query's content words, for
+# serving a near-duplicate query (1.0 = exact only), see SimilarityCache.
+EXPERT_CACHE_SIMILARITY = float(os.getenv('EXPERT_CACHE_SIMILARITY', '0.85'))
+
+# Every failure message returned by the `expert` tool starts with this text.
+EXPERT_ERROR_PREFIX = "Failed to get information from expert"
+
+# Execution mode: "tool_calling" lets the model call `expert` (two LLM round trips);
+# "retrieve_first" retrieves up front and answers in a single generation call.
+AGENT_MODE = os.getenv('AGENT_MODE', 'tool_calling')
 
 # --- LLM and Agent Definition ---
 
-# Initialize the language model provider
-# The provider is created once and reused.
-if OPEN_ROUTER_API_KEY:
-    model = OpenAIChatModel(
-        LLM_MODEL,
-        provider=OpenRouterProvider(api_key=OPEN_ROUTER_API_KEY),
-    )
-else:
-    # Fallback to default OpenAI provider if OpenRouter key is not set
-    model = OpenAIChatModel(LLM_MODEL)
+class TimedModel(WrapperModel):
+    """The configured model, built on first use, with every request timed for /metrics.
+
+    The model and its provider (and the OpenAI SDK import behind them) are only built on
+    the first request instead of on every import; warm_up() in the endpoint pays that at
+    startup.
+    """
+
+    def __init__(self):
+        Model.__init__(self)
+
+    @cached_property
+    def wrapped(self) -> Model:
+        # Built explicitly rather than from a "provider:model" string: the string's meaning
+        # depends on the pydantic-ai version (plain "openai:" may select the Responses API),
+        # and both OpenAI and OpenRouter are used through Chat Completions.
+        from pydantic_ai.models.openai import OpenAIChatModel
+
+        if OPEN_ROUTER_API_KEY:
+            from pydantic_ai.providers.openrouter import OpenRouterProvider
+
+            return OpenAIChatModel(LLM_MODEL, provider=OpenRouterProvider(api_key=OPEN_ROUTER_API_KEY))
+        # Fallback to default OpenAI provider if OpenRouter key is not set
+        return OpenAIChatModel(LLM_MODEL)
+
+    async def request(self, *args, **kwargs):
+        start = time.perf_counter()
+        status = "200"
+        try:
+            return await super().request(*args, **kwargs)
+        except ModelHTTPError as e:
+            status = str(e.status_code)
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            LLM_REQUEST_SECONDS.labels("request").observe(time.perf_counter() - start)
+            UPSTREAM_RESPONSES.labels("llm", status).inc()
+
+    @asynccontextmanager
+    async def request_stream(self, *args, **kwargs) -> AsyncIterator[StreamedResponse]:
+        start = time.perf_counter()
+        status = "200"
+        try:
+            async with super().request_stream(*args, **kwargs) as response:
+                yield response
+        except ModelHTTPError as e:
+            status = str(e.status_code)
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            LLM_REQUEST_SECONDS.labels("stream").observe(time.perf_counter() - start)
+            UPSTREAM_RESPONSES.labels("llm", status).inc()
+
+
+# One shared model instance for every agent.
+model = TimedModel()
 
 @dataclass
 class ExpertDeps:
@@ -40,8 +118,32 @@ class ExpertDeps:
     client: httpx.AsyncClient
     expert_api_key: str | None = None
 
-# The system prompt remains unchanged, defining the agent's persona and instructions.
-system_prompt = f"""
+
+def create_expert_client() -> httpx.AsyncClient:
+    """Create the pooled HTTP client shared by every `expert` tool call."""
+    http2 = EXPERT_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            # HTTP/2 needs the optional `h2` package (pip install "httpx[http2]").
+            print("EXPERT_HTTP2 is set but the 'h2' package is not installed; falling back to HTTP/1.1")
+            http2 = False
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=EXPERT_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=EXPERT_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=EXPERT_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+# The system prompt defines the agent's persona and instructions.
+# Optimization: It is a plain constant with nothing request-specific in it, so every request
+# starts with the same byte-identical prefix and qualifies for provider-side prompt caching
+# (OpenAI/OpenRouter cache prefixes of 1024+ tokens). Keep dates, names and other dynamic
+# values out of it; they belong in the user message.
+system_prompt = """
 <SYSTEM_PROMPT>
 
 <PERSONA>
@@ -135,45 +237,137 @@ system_prompt = f"""
 """
 
 # The agent is defined once.
+# Passed as `instructions` rather than `system_prompt`: instructions are sent as the first
+# message of every request, whereas a system prompt is only added when there is no message
+# history and would otherwise sit (or go missing) somewhere inside the replayed history.
 expert_agent = Agent(
     model,
-    system_prompt=system_prompt,
+    instructions=system_prompt,
     deps_type=ExpertDeps,
     retries=1  # Optimization: Reduced retries to fail faster if the API is unresponsive.
 )
 
-@expert_agent.tool
-async def expert(ctx: RunContext[ExpertDeps], query: str) -> str:
-    """Use this tool to get information about the Saudi bankruptcy law.
-    Args:
-        ctx: The context, which contains the shared httpx.AsyncClient.
-        query: The user's query about Saudi bankruptcy law.
-    Returns:
-        str: The answer to the user's query.
+# Optimization: Popular questions are answered from memory instead of re-POSTing to LightRAG.
+# Keyed on the canonicalized Arabic query, so tashkeel, hamza/taa marbuta spellings, word
+# order and boilerplate suffixes still hit. Only successful responses are cached.
+expert_cache = SimilarityCache(
+    max_bytes=EXPERT_CACHE_MAX_BYTES,
+    ttl=EXPERT_CACHE_TTL,
+    threshold=EXPERT_CACHE_SIMILARITY,
+)
+
+# Optimization: When a popular question spikes, concurrent agent runs share one upstream
+# POST per canonical query instead of each firing their own.
+expert_flight = SingleFlight()
+
+
+async def query_expert(deps: ExpertDeps, query: str) -> str:
+    """POST a query to the LightRAG endpoint and return the raw response text.
+
+    Raises httpx.RequestError or httpx.HTTPStatusError on failure.
     """
-    headers = {
-        'accept': 'application/json',
-        'X-API-Key': ctx.deps.expert_api_key
-    }
+    headers = {'accept': 'application/json'}
+    # httpx rejects a None header value, so an unset key sends no header at all.
+    if deps.expert_api_key:
+        headers['X-API-Key'] = deps.expert_api_key
     json_body = {'query': query}
-    
+
     # Optimization: Using the shared client from context avoids creating new connections.
     # The speed of this call is highly dependent on the external API's response time.
+    start = time.perf_counter()
+    status = "error"
+    try:
+        with tracer.start_as_current_span("expert POST", attributes={"http.url": EXPERT_API_URL}) as span:
+            response = await deps.client.post(
+                EXPERT_API_URL,
+                headers=headers,
+                json=json_body,
+                timeout=15.0  # Best Practice: Set a timeout to prevent indefinite waiting.
+            )
+            status = str(response.status_code)
+            span.set_attribute("http.status_code", response.status_code)
+    finally:
+        EXPERT_REQUEST_SECONDS.observe(time.perf_counter() - start)
+        UPSTREAM_RESPONSES.labels("expert", status).inc()
+    response.raise_for_status()  # Raise an exception for 4xx or 5xx status codes.
+    return response.text
+
+
+async def lookup_expert(deps: ExpertDeps, query: str) -> str:
+    """Return the expert result for `query` through the cache and single-flight layers.
+
+    Failures are returned as text starting with EXPERT_ERROR_PREFIX, never raised.
+    """
+    cached = expert_cache.get(query)
+    record_cache_lookup("expert", cached is not None)
+    if cached is not None:
+        return cached
+
     try:
-        response = await ctx.deps.client.post(
-            'https://n8n-lightrag.dfngk5.easypanel.host/query',
-            headers=headers,
-            json=json_body,
-            timeout=15.0  # Best Practice: Set a timeout to prevent indefinite waiting.
+        result = await expert_flight.do(
+            canonicalize_arabic(query),
+            lambda: query_expert(deps, query)
         )
-        response.raise_for_status()  # Raise an exception for 4xx or 5xx status codes.
-        return response.text
     except httpx.RequestError as e:
         # Handle network-related errors gracefully.
-        return f"Failed to get information from expert due to a network error: {e}"
+        return f"{EXPERT_ERROR_PREFIX} due to a network error: {e}"
     except httpx.HTTPStatusError as e:
         # Handle API error responses gracefully.
-        return f"Failed to get information from expert. The service responded with status {e.response.status_code}: {e.response.text}"
+        return f"{EXPERT_ERROR_PREFIX}. The service responded with status {e.response.status_code}: {e.response.text}"
+
+    expert_cache.set(query, result)
+    return result
+
+
+@expert_agent.tool
+async def expert(ctx: RunContext[ExpertDeps], query: str) -> str:
+    """Use this tool to get information about the Saudi bankruptcy law.
+    Args:
+        ctx: The context, which contains the shared httpx.AsyncClient.
+        query: The user's query about Saudi bankruptcy law.
+    Returns:
+        str: The answer to the user's query.
+    """
+    return await lookup_expert(ctx.deps, query)
+
+
+# --- Retrieve-First Mode ---
+# The same system prompt plus a note that the tool output is already in the message. The
+# note is appended, never prepended, so the cacheable prefix is shared with the tool-calling agent.
+retrieve_first_system_prompt = system_prompt + """
+<EXECUTION_MODE>
+    The `expert` tool has already been called with the user's question. Its output is given inside
+    <EXPERT_CONTEXT> in the user message. Do not call any tool: treat <EXPERT_CONTEXT> as the output
+    of STEP 3 and continue from STEP 4. If the query is out of scope, follow STEP 6 and ignore the context.
+</EXECUTION_MODE>
+"""
+
+# Optimization: With retrieval done up front, the answer needs one LLM round trip instead of
+# the model call -> tool call -> second model call of the tool-calling flow.
+answer_agent = Agent(
+    model,
+    instructions=retrieve_first_system_prompt,
+    deps_type=ExpertDeps,
+    retries=1
+)
+
+def rewrite_query(question: str) -> str:
+    """Cheap local rewrite of a user question into a retrieval query.
+
+    Anchors the question to the bankruptcy law when it does not mention it,
+    mirroring the query the agent would formulate in STEP 3.
+    """
+    query = " ".join(question.split())
+    # The unstripped form: stripping would remove a trailing "في نظام الإفلاس" before the check.
+    if "افلاس" not in canonicalize_arabic(query, strip_suffixes=False):
+        query = f"{query} في نظام الإفلاس السعودي"
+    return query
+
+
+async def build_retrieve_first_prompt(deps: ExpertDeps, question: str) -> str:
+    """Retrieve context for `question` and wrap both into the single-call user prompt."""
+    context = await lookup_expert(deps, rewrite_query(question))
+    return f"<EXPERT_CONTEXT>\n{context}\n</EXPERT_CONTEXT>\n\n<USER_QUERY>\n{question}\n</USER_QUERY>"
 
 
 # --- Main Execution Logic ---
@@ -181,11 +375,14 @@ async def run_agent_query(question: str):
     """
     Demonstrates the optimized way to run the agent by managing the httpx.AsyncClient lifecycle.
     """
+    # Only the CLI pretty-prints results, so the server never imports devtools.
+    from devtools import debug
+
     print(f"User Query: {question}\n")
     
     # Best Practice: Create the AsyncClient once and reuse it for multiple calls.
     # The `async with` block ensures the client is properly closed.
-    async with httpx.AsyncClient() as client:
+    async with create_expert_client() as client:
         # Instantiate the dependencies with the shared client.
         deps = ExpertDeps(
             client=client,
@@ -1,32 +1,105 @@
-from typing import List, Optional, Dict, Any
-from fastapi import FastAPI, HTTPException, Security, Depends
+from typing import List, Literal, Optional, Dict, Any
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from fastapi import FastAPI, HTTPException, Security, Depends, Request
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi.middleware.cors import CORSMiddleware
-from supabase import create_client, Client
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from dotenv import load_dotenv
 from pathlib import Path
-import httpx
+import asyncio
+import json
 import sys
 import os
+import time
 
 from pydantic_ai.messages import (
+    ModelMessage,
     ModelRequest,
-    ModelResponse,
-    UserPromptPart,
-    TextPart
+    ToolReturnPart,
+    UserPromptPart
 )
 
 # Add parent directory to Python path
 sys.path.append(str(Path(__file__).parent.parent))
 
-from Law_agent import expert_agent,ExpertDeps
+from Law_agent import (
+    expert_agent,
+    answer_agent,
+    ExpertDeps,
+    build_retrieve_first_prompt,
+    create_expert_client,
+    expert_cache,
+    expert_flight,
+    AGENT_MODE,
+    EXPERT_ERROR_PREFIX
+)
+from Law_agent_admission import AdmissionRejected, agent_gate
+from Law_agent_cache import TTLCache, canonicalize_arabic
+from Law_agent_classifier import classify_scope, get_scope_model, OUT_OF_SCOPE_REFUSAL
+from Law_agent_history import SUMMARY_TRIGGER_TOKENS, count_tokens, select_history, schedule_summary, summary_stats
+from Law_agent_metrics import (
+    StageTimer,
+    prompt_cache_stats,
+    record_cache_lookup,
+    record_request,
+    render_metrics,
+    run_record,
+    run_usage
+)
+from Law_agent_ratelimit import rate_limiter
+from Law_agent_tracing import setup_tracing, shutdown_tracing, traced_request, traced_stream
+from Law_agent_storage import dump_messages, get_supabase, load_session_history, store_message, message_writer, session_cache
+
+# First-turn answer cache: final outputs for sessions without history, keyed on the
+# canonicalized question. Set ANSWER_CACHE_MAX_ENTRIES=0 to disable.
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', '21600'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '1000'))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv('ANSWER_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+
+answer_cache = TTLCache(
+    max_bytes=ANSWER_CACHE_MAX_BYTES if ANSWER_CACHE_MAX_ENTRIES > 0 else 0,
+    ttl=ANSWER_CACHE_TTL,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+)
+
+def warm_up():
+    """Load what the first request would otherwise pay for.
 
-# Load environment variables
-load_dotenv()
+    Importing this module stays cheap; the tokenizer, the scope model and the model
+    SDK are loaded here instead, once per process (or once in the gunicorn master).
+    """
+    count_tokens("")
+    get_scope_model()
+    import pydantic_ai.models.openai  # noqa: F401
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Own the pooled HTTP client and the agent dependencies for the app lifetime."""
+    warm_up()
+    setup_tracing()
+    try:
+        await get_supabase()
+    except Exception as e:
+        # Not fatal at startup: every query retries creating the client.
+        print(f"Failed to create the Supabase client: {str(e)}")
+    # Optimization: One keep-alive pool per process means `expert` calls reuse warm
+    # connections to the LightRAG host instead of paying DNS/TCP/TLS setup every request.
+    async with create_expert_client() as client:
+        app.state.expert_deps = ExpertDeps(client=client, expert_api_key=os.getenv('EXPERT_API_KEY'))
+        await message_writer.start()
+        try:
+            yield
+        finally:
+            # Guarantee queued messages reach the database before the process exits.
+            await message_writer.close()
+            if rate_limiter is not None:
+                await rate_limiter.close()
+            shutdown_tracing()
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 security = HTTPBearer()
 
 app.add_middleware(
@@ -37,21 +110,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Supabase setup
-supabase: Client = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_KEY")
-)
-
 # Request/Response Models
 class AgentRequest(BaseModel):
     query: str
     user_id: str
     request_id: str
     session_id: str
+    bypass_cache: bool = False
+    # Set by the client on the first turn of a session it just created, so the
+    # history lookup is skipped entirely.
+    new_session: bool = False
+    # Overrides AGENT_MODE for this request.
+    mode: Optional[Literal["tool_calling", "retrieve_first"]] = None
 
 class AgentResponse(BaseModel):
     success: bool
+    timings: Optional[Dict[str, float]] = None
+    # Tokens of conversation history selected for the prompt, and the prompt tokens
+    # the model actually billed over all requests of the run.
+    history_tokens: Optional[int] = None
+    prompt_tokens: Optional[int] = None
+    # Part of prompt_tokens read from the provider's prompt cache.
+    cached_tokens: Optional[int] = None
 
 def verify_token(credentials: HTTPAuthorizationCredentials = Security(security)) -> bool:
     """Verify the bearer token against environment variable."""
@@ -68,96 +148,347 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Security(security))
         )
     return True    
 
-async def fetch_conversation_history(session_id: str, limit: int = 10) -> List[Dict[str, Any]]:
-    """Fetch the most recent conversation history for a session."""
-    try:
-        response = supabase.table("messages") \
-            .select("*") \
-            .eq("session_id", session_id) \
-            .order("created_at", desc=True) \
-            .limit(limit) \
-            .execute()
-        
-        # Convert to list and reverse to get chronological order
-        messages = response.data[::-1]
-        return messages
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to fetch conversation history: {str(e)}")
+def get_expert_deps(request: Request) -> ExpertDeps:
+    """Return the ExpertDeps built once in the lifespan hook."""
+    return request.app.state.expert_deps
 
-async def store_message(session_id: str, message_type: str, content: str, data: Optional[Dict] = None):
-    """Store a message in the Supabase messages table."""
-    message_obj = {
-        "type": message_type,
-        "content": content
-    }
-    if data:
-        message_obj["data"] = data
+def first_error(error: BaseException) -> BaseException:
+    """Unwrap the first leaf exception raised inside a TaskGroup."""
+    while isinstance(error, BaseExceptionGroup):
+        error = error.exceptions[0]
+    return error
 
-    try:
-        supabase.table("messages").insert({
-            "session_id": session_id,
-            "message": message_obj
-        }).execute()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to store message: {str(e)}")
+async def admit(request: AgentRequest):
+    """Raise AdmissionRejected if the user is over their rate limit, or if the request
+    will need an agent run and the wait queue is already full."""
+    if rate_limiter is not None:
+        decision = await rate_limiter.allow(request.user_id)
+        if not decision.allowed:
+            raise AdmissionRejected("rate_limited", decision.retry_after, status_code=429)
+    # Classifier refusals and answer-cache hits never take a slot, so a full queue does not
+    # shed them. A cached answer that turns out not to apply (the session has history) is
+    # still shed by agent_gate.acquire().
+    if classify_scope(request.query).out_of_scope:
+        return
+    if not request.bypass_cache and canonicalize_arabic(request.query) in answer_cache:
+        return
+    agent_gate.check()
+
+def shed_response(error: AdmissionRejected, content: Dict[str, Any]) -> JSONResponse:
+    """Reply to a request shed by the admission gate, with Retry-After."""
+    return JSONResponse(status_code=error.status_code, content=content, headers=error.headers())
+
+ERROR_MESSAGE = "I apologize, but I encountered an error processing your request."
+BUSY_MESSAGE = "I apologize, but the service is busy right now. Please try again in a few seconds."
+
+def is_cacheable_answer(new_messages: List[ModelMessage]) -> bool:
+    """An answer is reusable only if none of its `expert` calls or up-front retrievals failed."""
+    failed_context = f"<EXPERT_CONTEXT>\n{EXPERT_ERROR_PREFIX}"
+    for message in new_messages:
+        if isinstance(message, ModelRequest):
+            for part in message.parts:
+                if isinstance(part, ToolReturnPart) and str(part.content).startswith(EXPERT_ERROR_PREFIX):
+                    return False
+                if isinstance(part, UserPromptPart) and failed_context in str(part.content):
+                    return False
+    return True
+
+@dataclass
+class Turn:
+    """One request's turn, from prepare_turn through the agent run to finish_turn."""
+    request: AgentRequest
+    timer: StageTimer
+    data: Dict[str, Any]
+    messages: List[ModelMessage] = field(default_factory=list)
+    # Set when the turn is answered without an agent run (refusal or cached answer).
+    output: Optional[str] = None
+    agent: Any = None
+    prompt: Optional[str] = None
+    use_answer_cache: bool = False
+    history_tokens: Optional[int] = None
+    prompt_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+
+    def record_run(self, result, output: str):
+        """Take the output, usage and messages of a finished agent run."""
+        self.output = output
+        usage = run_usage(result)
+        self.prompt_tokens = usage.input_tokens
+        self.cached_tokens = prompt_cache_stats.record(usage)
+        self.data.update(run_record(result))
+        new_messages = result.new_messages()
+        if self.use_answer_cache and is_cacheable_answer(new_messages):
+            answer_cache.set(canonicalize_arabic(self.request.query), output)
+        # Keep the whole run, tool calls and returns included, so follow-up turns
+        # can reuse earlier `expert` results instead of retrieving them again.
+        self.data["messages"] = dump_messages(new_messages)
+
+async def prepare_turn(request: AgentRequest, deps: ExpertDeps, timer: StageTimer) -> Turn:
+    """Store the query and work out everything the turn needs before the agent runs.
+
+    Returns a Turn whose `output` is already set when no agent run is needed.
+    """
+    turn = Turn(request=request, timer=timer, data={"request_id": request.request_id})
+    # History is read as of the start of the request, so the user's query stored
+    # concurrently below never shows up in its own history.
+    history_cutoff = datetime.now(timezone.utc)
+    # Optimization: Questions a local classifier is confident are out of scope get the
+    # templated refusal in well under a millisecond, with no history read or model call.
+    scope = classify_scope(request.query)
+
+    # Optimization: Storing the user's query does not feed the agent, so it runs alongside
+    # the history fetch instead of before it. The TaskGroup cancels the other as soon as
+    # either fails; it is closed before the agent runs, since the streaming endpoint must
+    # not yield inside it.
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(timer.measure("store_user_message", store_message(
+            session_id=request.session_id,
+            message_type="human",
+            content=request.query
+        )))
+        if not scope.out_of_scope:
+            # Fetch conversation history, already converted to the format expected by the agent
+            turn.messages = await timer.measure("history_fetch", load_session_history(
+                request.session_id,
+                before=history_cutoff,
+                new_session=request.new_session,
+                summaries=SUMMARY_TRIGGER_TOKENS > 0
+            ))
+
+    if scope.out_of_scope:
+        turn.output = OUT_OF_SCOPE_REFUSAL
+        turn.data["scope_classifier"] = scope.as_dict()
+        return turn
+
+    # Optimization: Fill the history window newest-first up to a token budget instead of a
+    # fixed row count, so long legal answers cannot blow up prompt size and latency.
+    if turn.messages:
+        turn.messages, turn.history_tokens = select_history(turn.messages)
+    # Optimization: A first turn has no history, so its answer depends only on the question.
+    # Serve a stored answer and skip both LLM round trips and the retrieval call.
+    elif not request.bypass_cache:
+        turn.use_answer_cache = True
+        turn.output = answer_cache.get(canonicalize_arabic(request.query))
+        record_cache_lookup("answer", turn.output is not None)
+        if turn.output is not None:
+            turn.data["answer_cache"] = "hit"
+            return turn
+
+    turn.agent, turn.prompt = expert_agent, request.query
+    if (request.mode or AGENT_MODE) == "retrieve_first":
+        # Retrieve up front and answer in a single generation call.
+        turn.agent = answer_agent
+        turn.prompt = await timer.measure("retrieval", build_retrieve_first_prompt(deps, request.query))
+        turn.data["mode"] = "retrieve_first"
+    return turn
+
+async def finish_turn(turn: Turn):
+    """Store the answer with the turn's timings and schedule the session summary."""
+    # Per-stage timings up to this point, so slow turns can be found from the messages table.
+    turn.data["timings"] = turn.timer.snapshot()
+    await turn.timer.measure("store_ai_message", store_message(
+        session_id=turn.request.session_id,
+        message_type="ai",
+        data=turn.data,
+        content=turn.output
+    ))
+    # Optimization: Compact older turns into the session summary after replying, so the
+    # next request resends one summary instead of their raw text.
+    schedule_summary(turn.request.session_id)
+
+async def store_failure(request: AgentRequest, timer: StageTimer, error: BaseException, shed: bool):
+    """Store the apology shown in place of an answer, with the error and timings."""
+    await store_message(
+        session_id=request.session_id,
+        message_type="ai",
+        content=BUSY_MESSAGE if shed else ERROR_MESSAGE,
+        data={"error": str(error), "request_id": request.request_id, "timings": timer.snapshot()}
+    )
 
 @app.post("/api/pydantic-Law-agent", response_model=AgentResponse)
+@traced_request("LAW_agent_endpoint")
 async def LAW_agent_endpoint(
-    request: AgentRequest#,
+    request: AgentRequest,
+    deps: ExpertDeps = Depends(get_expert_deps)#,
     #authenticated: bool = Depends(verify_token)
 ):
+    timer = StageTimer()
+    # Optimization: When the user is over their rate limit or the wait queue in front of the model
+    # is already full, shed the request before it stores or reads anything.
     try:
-        # Fetch conversation history
-        conversation_history = await fetch_conversation_history(request.session_id)
-        
-        # Convert conversation history to format expected by agent
-        messages = []
-        for msg in conversation_history:
-            msg_data = msg["message"]
-            msg_type = msg_data["type"]
-            msg_content = msg_data["content"]
-            msg = ModelRequest(parts=[UserPromptPart(content=msg_content)]) if msg_type == "human" else ModelResponse(parts=[TextPart(content=msg_content)])
-            messages.append(msg)
-
-        # Store user's query
-        await store_message(
-            session_id=request.session_id,
-            message_type="human",
-            content=request.query
-        )            
-
-        # Initialize agent dependencies
-        async with httpx.AsyncClient() as client:
-            deps = ExpertDeps(client=client, expert_api_key=os.getenv('EXPERT_API_KEY'))
+        await admit(request)
+    except AdmissionRejected as e:
+        timings = timer.finish()
+        record_request("blocking", e.reason, timings["total"])
+        return shed_response(e, AgentResponse(success=False, timings=timings).model_dump())
 
-            # Run the agent with conversation history
-            result = await expert_agent.run(
-                request.query,
-                message_history=messages,
-                deps=deps
-            )
+    try:
+        turn = await prepare_turn(request, deps, timer)
+        if turn.output is None:
+            # Run the agent with conversation history, once the admission gate grants a slot.
+            await timer.measure("admission_wait", agent_gate.acquire())
+            try:
+                result = await timer.measure("agent_run", turn.agent.run(
+                    turn.prompt,
+                    message_history=turn.messages,
+                    deps=deps
+                ))
+            finally:
+                agent_gate.release()
+            turn.record_run(result, result.output)
+        await finish_turn(turn)
 
-        # Store agent's response
-        await store_message(
-            session_id=request.session_id,
-            message_type="ai",
-            data={"request_id": request.request_id},
-            content=result.output
+        timings = timer.finish()
+        record_request("blocking", "success", timings["total"])
+        return AgentResponse(
+            success=True,
+            timings=timings,
+            history_tokens=turn.history_tokens,
+            prompt_tokens=turn.prompt_tokens,
+            cached_tokens=turn.cached_tokens
         )
 
-        return AgentResponse(success=True)
-
     except Exception as e:
-        print(f"Error processing agent request: {str(e)}")
+        e = first_error(e)
+        shed = isinstance(e, AdmissionRejected)
+        if not shed:
+            print(f"Error processing agent request: {str(e)}")
         # Store error message in conversation
-        await store_message(
-            session_id=request.session_id,
-            message_type="ai",
-            content="I apologize, but I encountered an error processing your request.",
-            data={"error": str(e), "request_id": request.request_id}
-        )
-        return AgentResponse(success=False)
+        await store_failure(request, timer, e, shed)
+        response = AgentResponse(success=False, timings=timer.finish())
+        record_request("blocking", e.reason if shed else "failure", response.timings["total"])
+        if shed:
+            return shed_response(e, response.model_dump())
+        return response
+
+class StreamLatency:
+    """Running time-to-first-token and total latency for the streaming endpoint."""
+
+    def __init__(self):
+        self.streams = 0
+        self.ttft_ms_total = 0.0
+        self.total_ms_total = 0.0
+        self.last_ttft_ms: Optional[float] = None
+        self.last_total_ms: Optional[float] = None
+
+    def record(self, ttft_ms: float, total_ms: float):
+        self.streams += 1
+        self.ttft_ms_total += ttft_ms
+        self.total_ms_total += total_ms
+        self.last_ttft_ms = ttft_ms
+        self.last_total_ms = total_ms
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "streams": self.streams,
+            "avg_ttft_ms": round(self.ttft_ms_total / self.streams, 1) if self.streams else None,
+            "avg_total_ms": round(self.total_ms_total / self.streams, 1) if self.streams else None,
+            "last_ttft_ms": self.last_ttft_ms,
+            "last_total_ms": self.last_total_ms,
+        }
+
+stream_latency = StreamLatency()
+
+def sse_event(event: str, payload: Dict[str, Any]) -> str:
+    """Format one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.post("/api/pydantic-Law-agent/stream")
+async def LAW_agent_stream_endpoint(
+    request: AgentRequest,
+    deps: ExpertDeps = Depends(get_expert_deps)#,
+    #authenticated: bool = Depends(verify_token)
+):
+    """Stream the answer as Server-Sent Events (`token`, then `done` or `error`)."""
+    # Shed before the stream starts, while a status code can still be returned.
+    timer = StageTimer()
+    try:
+        await admit(request)
+    except AdmissionRejected as e:
+        record_request("stream", e.reason, timer.finish()["total"])
+        return shed_response(e, {"success": False})
+
+    async def event_stream():
+        start = time.perf_counter()
+        ttft_ms = None
+        try:
+            turn = await prepare_turn(request, deps, timer)
+            if turn.output is None:
+                async with agent_gate.slot(), turn.agent.run_stream(
+                    turn.prompt,
+                    message_history=turn.messages,
+                    deps=deps
+                ) as result:
+                    async for delta in result.stream_text(delta=True):
+                        if ttft_ms is None:
+                            ttft_ms = (time.perf_counter() - start) * 1000
+                        yield sse_event("token", {"delta": delta})
+                    turn.record_run(result, await result.get_output())
+            else:
+                ttft_ms = (time.perf_counter() - start) * 1000
+                yield sse_event("token", {"delta": turn.output})
+
+            total_ms = (time.perf_counter() - start) * 1000
+            ttft_ms = total_ms if ttft_ms is None else ttft_ms
+            stream_latency.record(ttft_ms, total_ms)
+            turn.data.update({"ttft_ms": round(ttft_ms, 1), "total_ms": round(total_ms, 1)})
+
+            # Persist the complete text through the same path as the blocking endpoint.
+            await finish_turn(turn)
+            record_request("stream", "success", timer.finish()["total"])
+            yield sse_event("done", {
+                "success": True,
+                "ttft_ms": turn.data["ttft_ms"],
+                "total_ms": turn.data["total_ms"],
+                "history_tokens": turn.history_tokens,
+                "prompt_tokens": turn.prompt_tokens,
+                "cached_tokens": turn.cached_tokens
+            })
+
+        except Exception as e:
+            e = first_error(e)
+            shed = isinstance(e, AdmissionRejected)
+            if not shed:
+                print(f"Error processing streaming agent request: {str(e)}")
+            await store_failure(request, timer, e, shed)
+            record_request("stream", e.reason if shed else "failure", timer.finish()["total"])
+            # The status line has already been sent, so a shed stream reports the retry delay here.
+            yield sse_event("error", {"success": False, "retry_after": e.retry_after} if shed else {"success": False})
+
+    return StreamingResponse(
+        traced_stream("LAW_agent_stream_endpoint", request, event_stream()),
+        media_type="text/event-stream",
+        # Disable proxy buffering so tokens reach the client as they are generated.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint."""
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+@app.get("/api/pydantic-Law-agent/stats")
+async def LAW_agent_stats():
+    """Process-local counters for tuning caches.
+
+    With several workers each one keeps its own counters; `pid` tells them apart.
+    """
+    return {
+        "pid": os.getpid(),
+        "expert_cache": expert_cache.stats(),
+        "expert_single_flight": expert_flight.stats(),
+        "answer_cache": answer_cache.stats(),
+        "stream_latency": stream_latency.stats(),
+        "message_writer": message_writer.stats(),
+        "session_cache": session_cache.stats(),
+        "summarizer": summary_stats.stats(),
+        "prompt_cache": prompt_cache_stats.stats(),
+        "admission": agent_gate.stats(),
+        "rate_limit": rate_limiter.stats() if rate_limiter is not None else None,
+    }
 
 if __name__ == "__main__":
+    # Single development process; production runs `gunicorn -c gunicorn.conf.py Law_agent_Endpoint:app`.
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
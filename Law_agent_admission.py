@@ -0,0 +1,131 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from Law_agent_config import load_env
+from Law_agent_metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUED
+
+load_env()
+
+# Concurrency gate in front of the model calls (AGENT_MAX_CONCURRENCY=0 disables it).
+AGENT_MAX_CONCURRENCY = int(os.getenv("AGENT_MAX_CONCURRENCY", "32"))
+# Requests allowed to wait for a free slot, and how long each may wait, before being shed.
+AGENT_MAX_QUEUE = int(os.getenv("AGENT_MAX_QUEUE", "64"))
+AGENT_MAX_QUEUE_WAIT = float(os.getenv("AGENT_MAX_QUEUE_WAIT", "10"))
+# Seconds sent in the Retry-After header of a shed request.
+AGENT_RETRY_AFTER = int(os.getenv("AGENT_RETRY_AFTER", "5"))
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed instead of being admitted."""
+
+    def __init__(self, reason: str, retry_after: int, status_code: int = 503):
+        super().__init__(f"Request rejected ({reason}); retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(self.retry_after)}
+
+
+class AdmissionGate:
+    """Bounded concurrency with a bounded, time-limited wait queue.
+
+    At most `max_concurrent` holders run at once and at most `max_queue` more wait
+    for a slot, each for at most `max_wait` seconds. Anything beyond that is
+    rejected immediately, so a spike is shed at the door instead of piling onto the
+    upstream model until every request times out together.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, max_wait: float, retry_after: int):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent > 0 else None
+        self.in_flight = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.wait_ms_total = 0.0
+        self.last_wait_ms: Optional[float] = None
+
+    def check(self):
+        """Raise AdmissionRejected if a new request could not even join the queue.
+
+        Lets a handler shed a request up front, before it has side effects.
+        """
+        if self._semaphore is not None and self._semaphore.locked() and self.queued >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise AdmissionRejected("queue_full", self.retry_after)
+
+    async def acquire(self):
+        """Wait for a slot or raise AdmissionRejected."""
+        if self._semaphore is None:
+            self.in_flight += 1
+            ADMISSION_IN_FLIGHT.inc()
+            return
+        # A free slot with nobody queued ahead is taken without touching the queue.
+        if self._semaphore.locked():
+            self.check()
+            self.queued += 1
+            ADMISSION_QUEUED.inc()
+            self.peak_queued = max(self.peak_queued, self.queued)
+            start = time.perf_counter()
+            try:
+                async with asyncio.timeout(self.max_wait):
+                    await self._semaphore.acquire()
+            except TimeoutError:
+                self.rejected_timeout += 1
+                raise AdmissionRejected("queue_timeout", self.retry_after) from None
+            finally:
+                self.queued -= 1
+                ADMISSION_QUEUED.dec()
+            self.last_wait_ms = round((time.perf_counter() - start) * 1000, 1)
+            self.wait_ms_total += self.last_wait_ms
+        else:
+            await self._semaphore.acquire()
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.inc()
+        self.admitted += 1
+
+    def release(self):
+        self.in_flight -= 1
+        ADMISSION_IN_FLIGHT.dec()
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "peak_queued": self.peak_queued,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "avg_wait_ms": round(self.wait_ms_total / self.admitted, 1) if self.admitted else None,
+            "last_wait_ms": self.last_wait_ms,
+        }
+
+
+agent_gate = AdmissionGate(
+    max_concurrent=AGENT_MAX_CONCURRENCY,
+    max_queue=AGENT_MAX_QUEUE,
+    max_wait=AGENT_MAX_QUEUE_WAIT,
+    retry_after=AGENT_RETRY_AFTER,
+)
@@ -0,0 +1,371 @@
+import asyncio
+import random
+import re
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+
+# --- Arabic Canonicalization ---
+# Tashkeel (harakat, tanween, shadda, sukun, superscript alef) and Quranic annotation marks.
+_TASHKEEL = re.compile("[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED]")
+_TATWEEL = "\u0640"
+_LETTER_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",  # alef/hamza variants
+    "ة": "ه",  # taa marbuta vs haa
+    "ى": "ي",  # alef maqsura vs yaa
+    "ؤ": "و",
+    "ئ": "ي",
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4",
+    "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+})
+_PUNCTUATION = re.compile(r"[^\w\s]|_")
+
+# Phrases the model tends to append to an otherwise identical query. They are
+# written in canonical form and stripped from the end of the query.
+BOILERPLATE_SUFFIXES = (
+    "في نظام الافلاس السعودي",
+    "في نظام الافلاس",
+    "حسب نظام الافلاس السعودي",
+    "حسب نظام الافلاس",
+    "في السعوديه",
+    "السعودي",
+)
+
+
+def canonicalize_arabic(text: str, strip_suffixes: bool = True) -> str:
+    """Fold spelling variants of an Arabic query onto one canonical string.
+
+    Removes tashkeel and tatweel, unifies alef/hamza, taa marbuta and alef maqsura
+    forms, drops punctuation and, unless `strip_suffixes` is False, strips trailing
+    boilerplate such as "في نظام الإفلاس".
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _TASHKEEL.sub("", text).replace(_TATWEEL, "")
+    text = text.translate(_LETTER_MAP)
+    text = " ".join(_PUNCTUATION.sub(" ", text).split())
+    stripped = strip_suffixes
+    while stripped:
+        stripped = False
+        for suffix in BOILERPLATE_SUFFIXES:
+            if text.endswith(suffix) and len(text) > len(suffix):
+                text = text[: -len(suffix)].rstrip()
+                stripped = True
+    return text
+
+
+# Question words and particles, in canonical form, that do not change what is being asked.
+STOP_WORDS = frozenset((
+    "ما", "ماهي", "ماهو", "هي", "هو", "هل", "كيف", "متي", "اين", "لماذا", "من", "في", "علي", "عن",
+    "الي", "او", "و", "ثم", "ان", "الذي", "التي", "هذا", "هذه", "ذلك", "تلك", "لي", "عند", "يتم",
+    "بين", "مع", "كل", "اي", "يا", "لو", "سمحت", "ممكن", "اريد", "ابغي", "ابي", "اعرف",
+))
+
+
+def content_words(text: str) -> FrozenSet[str]:
+    """Words of a canonical text that carry its meaning, i.e. without STOP_WORDS."""
+    return frozenset(word for word in text.split() if word not in STOP_WORDS)
+
+
+def char_shingles(text: str, n: int = 3) -> FrozenSet[str]:
+    """Character n-grams taken per word, so the set does not depend on word order."""
+    shingles = set()
+    for word in text.split():
+        padded = f" {word} "
+        if len(padded) <= n:
+            shingles.add(padded)
+        else:
+            shingles.update(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return frozenset(shingles)
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def _text_size(key: str, value: Any) -> int:
+    """Approximate memory held by an entry as the UTF-8 size of its key and value."""
+    return len(key.encode("utf-8")) + len(str(value).encode("utf-8"))
+
+
+class TTLCache:
+    """Bounded in-process cache with TTL expiry, LRU eviction and byte-size accounting.
+
+    Entries older than `ttl` seconds are treated as missing. When adding an entry
+    would exceed `max_bytes` (or `max_entries`), the least recently used entries
+    are evicted until it fits. A `max_bytes` of 0 disables the cache.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        max_entries: Optional[int] = None,
+        sizeof: Callable[[str, Any], int] = _text_size,
+        on_remove: Optional[Callable[[str], None]] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sizeof = sizeof
+        self.on_remove = on_remove
+        self._entries: "OrderedDict[str, Tuple[Any, float, int]]" = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[1] > time.monotonic()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for `key`, or None on a miss or an expired entry."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: str) -> Optional[Any]:
+        """Like get, but without touching the LRU order or the hit/miss counters."""
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, key: str, value: Any):
+        """Insert or replace `key`, evicting least recently used entries to stay in bounds."""
+        size = self.sizeof(key, value)
+        if size > self.max_bytes:
+            self.rejections += 1
+            return
+        if key in self._entries:
+            self._remove(key)
+        while self._entries and (
+            self.current_bytes + size > self.max_bytes
+            or (self.max_entries is not None and len(self._entries) >= self.max_entries)
+        ):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+        self._entries[key] = (value, time.monotonic() + self.ttl, size)
+        self.current_bytes += size
+
+    def delete(self, key: str):
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self):
+        for key in list(self._entries):
+            self._remove(key)
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters for tuning the cache size and TTL."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "rejections": self.rejections,
+        }
+
+
+# --- Near-Duplicate Lookup ---
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+class MinHashLSH:
+    """MinHash signatures over shingle sets, banded into an LSH index.
+
+    With `bands` bands of `num_perm // bands` rows each, two sets become
+    candidates when any band of their signatures collides, which happens with
+    high probability once their Jaccard similarity is above roughly
+    (1 / bands) ** (bands / num_perm).
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        rng = random.Random(seed)
+        self.rows = num_perm // bands
+        self.bands = bands
+        self._params = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], Set[str]] = {}
+        self._band_keys: Dict[str, List[Tuple[int, Tuple[int, ...]]]] = {}
+
+    def signature(self, shingles: FrozenSet[str]) -> Tuple[int, ...]:
+        # crc32 is stable across processes, unlike the salted built-in hash().
+        hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles] or [0]
+        return tuple(
+            min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+            for a, b in self._params
+        )
+
+    def _bands(self, signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+        return [
+            (band, signature[band * self.rows:(band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
+
+    def insert(self, key: str, shingles: FrozenSet[str]):
+        self.remove(key)
+        band_keys = self._bands(self.signature(shingles))
+        for band_key in band_keys:
+            self._buckets.setdefault(band_key, set()).add(key)
+        self._band_keys[key] = band_keys
+
+    def remove(self, key: str):
+        for band_key in self._band_keys.pop(key, ()):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def candidates(self, shingles: FrozenSet[str]) -> Set[str]:
+        found: Set[str] = set()
+        for band_key in self._bands(self.signature(shingles)):
+            found.update(self._buckets.get(band_key, ()))
+        return found
+
+
+class SimilarityCache:
+    """TTLCache keyed on canonical Arabic text with a MinHash/LSH near-duplicate fallback.
+
+    A lookup first tries the canonical query as an exact key. On a miss, LSH
+    candidates are verified with exact Jaccard similarity over the character
+    shingles of their content words (see content_words), so question words and
+    filler do not dilute the score, and the best one at or above `threshold` is
+    served. Candidates must also have as many content words as the query, which
+    keeps a query with one more qualifier ("التصفية الإدارية" vs "التصفية") from
+    getting the other's result, however similar the strings are.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, threshold: float = 0.8, shingle_size: int = 3):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.cache = TTLCache(max_bytes=max_bytes, ttl=ttl, on_remove=self._unindex)
+        self.index = MinHashLSH()
+        self._shingles: Dict[str, FrozenSet[str]] = {}
+        self._words: Dict[str, FrozenSet[str]] = {}
+        self.similar_hits = 0
+
+    def _unindex(self, key: str):
+        self._shingles.pop(key, None)
+        self._words.pop(key, None)
+        self.index.remove(key)
+
+    def get(self, query: str) -> Optional[Any]:
+        key = canonicalize_arabic(query)
+        value = self.cache.get(key)
+        if value is not None or self.threshold >= 1.0:
+            return value
+
+        words = content_words(key)
+        shingles = char_shingles(" ".join(words), self.shingle_size)
+        best_key, best_score = None, self.threshold
+        for candidate in self.index.candidates(shingles):
+            if len(self._words[candidate]) != len(words):
+                continue
+            score = jaccard(shingles, self._shingles[candidate])
+            if score >= best_score:
+                best_key, best_score = candidate, score
+        if best_key is None:
+            return None
+        # peek: the miss above was already counted, this lookup is not a second one.
+        value = self.cache.peek(best_key)
+        if value is not None:
+            self.similar_hits += 1
+        return value
+
+    def set(self, query: str, value: Any):
+        key = canonicalize_arabic(query)
+        self.cache.set(key, value)
+        if key in self.cache:
+            words = content_words(key)
+            shingles = char_shingles(" ".join(words), self.shingle_size)
+            self._shingles[key] = shingles
+            self._words[key] = words
+            self.index.insert(key, shingles)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.cache.stats()
+        stats["similar_hits"] = self.similar_hits
+        stats["threshold"] = self.threshold
+        return stats
+
+
+# --- Request Coalescing ---
+class SingleFlight:
+    """Run at most one in-flight call per key; concurrent callers share its result.
+
+    The first caller for a key starts the call as a task and every caller,
+    including the first, awaits it through asyncio.shield, so a cancelled
+    caller does not cancel the shared call for the others. A raised exception
+    is delivered to every waiter.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, "asyncio.Task[Any]"] = {}
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            self.executions += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, key=key: self._done(key, t))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: "asyncio.Task[Any]"):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved in case every waiter was cancelled.
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._inflight),
+            "calls": self.calls,
+            "upstream_calls": self.executions,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,324 @@
+"""
+Local scope pre-classifier for the law agent.
+
+Decides, before any model call, whether a question is clearly outside the Saudi
+Bankruptcy Law so the templated refusal can be returned without an LLM round
+trip. It combines keyword lexicons with a logistic-regression model over hashed
+character n-grams. Anything it is not confident about is left to the agent.
+
+The model is trained from logged sessions in the Supabase `messages` table:
+a reply that called the `expert` tool marks its question as in scope, and a
+refusal without a tool call marks it as out of scope.
+
+Usage:
+    python Law_agent_classifier.py train --out scope_model.json
+    python Law_agent_classifier.py classify "كيف أؤسس شركة تجارية في الرياض؟"
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import zlib
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from Law_agent_cache import canonicalize_arabic
+from Law_agent_config import load_env
+
+# --- Configuration ---
+load_env()
+SCOPE_CLASSIFIER_ENABLED = os.getenv("SCOPE_CLASSIFIER_ENABLED", "true").lower() in ("1", "true", "yes")
+SCOPE_MODEL_PATH = Path(os.getenv("SCOPE_MODEL_PATH", str(Path(__file__).parent / "scope_model.json")))
+# Minimum model probability of "out of scope" for refusing without a lexicon match.
+SCOPE_MODEL_THRESHOLD = float(os.getenv("SCOPE_MODEL_THRESHOLD", "0.95"))
+
+# The templated Saudi-dialect refusal from the system prompt's out-of-scope example.
+OUT_OF_SCOPE_REFUSAL = (
+    "عفواً، ولكن هذا السؤال يقع خارج نطاق تخصصي. أنا مختص فقط في نظام الإفلاس السعودي "
+    "ولا أملك الصلاحية أو المعلومات لتقديم استشارات حول هذا الموضوع."
+)
+
+# Lexicons, written in canonical form (see canonicalize_arabic) and matched against whole
+# words, so "راتب" does not fire inside "مراتب". Any in-scope term sends the question to
+# the agent no matter what else it contains; an out-of-scope term alone never refuses.
+IN_SCOPE_TERMS = (
+    "افلاس", "مفلس", "تفليس", "اعسار", "معسر", "متعثر", "تعثر",
+    "تصفيه", "تسويه وقائيه", "اعاده التنظيم", "امين", "دائن", "مدين", "مديونيه",
+    "ديون", "الدين", "مطالبه", "مطالبات", "مقترح", "محكمه", "قاضي", "رهن", "ضمان",
+    "لجنه الافلاس", "سداد", "توقف عن الدفع", "حجز", "bankrupt", "insolven", "liquidat", "creditor", "debtor",
+)
+OUT_OF_SCOPE_TERMS = (
+    "تاسيس", "اوسس", "افتح شركه", "فتح محل", "سجل تجاري", "رخصه", "تاشيره", "تجديد اقامه", "جواز سفر",
+    "زواج", "طلاق", "حضانه", "نفقه", "ميراث", "وصيه", "عقد ايجار",
+    "مخالفه مروريه", "ضريبه القيمه المضافه", "تامينات اجتماعيه",
+    "وصفه", "طبخ", "مباراه", "الطقس", "برمجه", "بايثون", "ترجم", "قصيده",
+    "recipe", "weather", "football", "python", "visa",
+)
+
+# Attached prefixes (conjunction, preposition, article) and the plural and pronoun endings
+# a lexicon word may carry in a question: "والدائنين" matches "دائن".
+_PROCLITICS = ("وال", "بال", "فال", "كال", "لل", "ال", "و", "ف", "ب", "ل", "ك")
+_ENDINGS = ("", "ين", "ون", "ات", "ان", "ه", "ها", "هم", "ي", "يه")
+
+# Model features: hashed character n-grams of the canonical text.
+_NGRAM_SIZES = (2, 3, 4)
+_FEATURE_BITS = 18
+
+
+@dataclass
+class ScopeDecision:
+    """Outcome of the local scope check."""
+    out_of_scope: bool
+    reason: str
+    probability: Optional[float] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "reason": self.reason,
+            "probability": None if self.probability is None else round(self.probability, 4),
+        }
+
+
+def _features(canonical: str) -> List[int]:
+    padded = f" {canonical} "
+    mask = (1 << _FEATURE_BITS) - 1
+    features = set()
+    for n in _NGRAM_SIZES:
+        for i in range(len(padded) - n + 1):
+            features.add(zlib.crc32(f"{n}:{padded[i:i + n]}".encode("utf-8")) & mask)
+    return sorted(features)
+
+
+def _word_forms(token: str) -> List[str]:
+    forms = [token]
+    for prefix in _PROCLITICS:
+        if token.startswith(prefix) and len(token) - len(prefix) >= 3:
+            forms.append(token[len(prefix):])
+    return forms
+
+
+def _word_matches(word: str, forms: List[str]) -> bool:
+    if word.isascii():
+        # English terms are stems: "insolven" covers insolvent and insolvency.
+        return any(form.startswith(word) for form in forms)
+    return any(form.startswith(word) and form[len(word):] in _ENDINGS for form in forms)
+
+
+@lru_cache(maxsize=None)
+def _canonical_terms(terms: Tuple[str, ...]) -> Tuple[Tuple[str, ...], ...]:
+    # Some terms are typed with hamza forms ("دائن"); fold them like the question.
+    return tuple(tuple(canonicalize_arabic(term, strip_suffixes=False).split()) for term in terms)
+
+
+def lexicon_match(text: str, terms: Tuple[str, ...]) -> Optional[str]:
+    """First term whose words occur as consecutive whole words of the canonical `text`."""
+    tokens = [_word_forms(token) for token in text.split()]
+    for term, words in zip(terms, _canonical_terms(terms)):
+        for i in range(len(tokens) - len(words) + 1):
+            if all(_word_matches(word, tokens[i + j]) for j, word in enumerate(words)):
+                return term
+    return None
+
+
+def _sigmoid(z: float) -> float:
+    if z < -35:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-z))
+
+
+class ScopeModel:
+    """Logistic regression over hashed character n-grams; predicts P(out of scope)."""
+
+    def __init__(self, weights: Optional[Dict[int, float]] = None, bias: float = 0.0):
+        self.weights = weights or {}
+        self.bias = bias
+
+    def _score(self, features: List[int]) -> float:
+        scale = 1.0 / math.sqrt(len(features)) if features else 0.0
+        return self.bias + scale * sum(self.weights.get(f, 0.0) for f in features)
+
+    def predict(self, canonical: str) -> float:
+        return _sigmoid(self._score(_features(canonical)))
+
+    def fit(self, samples: List[Tuple[str, int]], epochs: int = 15, lr: float = 0.5, l2: float = 1e-4, seed: int = 1):
+        """Train with plain SGD on (canonical text, label) pairs, label 1 = out of scope."""
+        rng = random.Random(seed)
+        data = [(_features(text), label) for text, label in samples]
+        for _ in range(epochs):
+            rng.shuffle(data)
+            for features, label in data:
+                if not features:
+                    continue
+                scale = 1.0 / math.sqrt(len(features))
+                gradient = _sigmoid(self._score(features)) - label
+                for f in features:
+                    weight = self.weights.get(f, 0.0)
+                    self.weights[f] = weight - lr * (gradient * scale + l2 * weight)
+                self.bias -= lr * gradient
+        return self
+
+    def save(self, path: Path):
+        path.write_text(json.dumps({
+            "feature_bits": _FEATURE_BITS,
+            "ngram_sizes": list(_NGRAM_SIZES),
+            "bias": self.bias,
+            "weights": {str(f): round(w, 6) for f, w in self.weights.items() if abs(w) > 1e-6},
+        }))
+
+    @classmethod
+    def load(cls, path: Path) -> "ScopeModel":
+        data = json.loads(path.read_text())
+        if data.get("feature_bits") != _FEATURE_BITS or tuple(data.get("ngram_sizes", ())) != _NGRAM_SIZES:
+            raise ValueError(f"{path} was trained with different feature settings")
+        return cls({int(f): w for f, w in data["weights"].items()}, data["bias"])
+
+
+@lru_cache(maxsize=1)
+def get_scope_model() -> Optional[ScopeModel]:
+    """Load the trained model on first use, or None if there is none."""
+    if not SCOPE_MODEL_PATH.exists():
+        return None
+    try:
+        return ScopeModel.load(SCOPE_MODEL_PATH)
+    except Exception as e:
+        print(f"Ignoring scope model {SCOPE_MODEL_PATH}: {str(e)}")
+        return None
+
+
+def classify_scope(query: str) -> ScopeDecision:
+    """Decide whether `query` is confidently out of scope.
+
+    Returns out_of_scope=False for everything in scope or uncertain, which then
+    goes to the agent as before.
+    """
+    if not SCOPE_CLASSIFIER_ENABLED:
+        return ScopeDecision(False, "disabled")
+
+    # The lexicons see the full question: the boilerplate suffixes stripped for cache keys
+    # ("في نظام الإفلاس") are the strongest in-scope signal there is.
+    if lexicon_match(canonicalize_arabic(query, strip_suffixes=False), IN_SCOPE_TERMS):
+        return ScopeDecision(False, "in_scope_lexicon")
+
+    canonical = canonicalize_arabic(query)
+    scope_model = get_scope_model()
+    probability = scope_model.predict(canonical) if scope_model is not None else None
+    if lexicon_match(canonical, OUT_OF_SCOPE_TERMS):
+        # A lexicon hit refuses only together with a trained model that leans out of scope.
+        if probability is not None and probability >= 0.5:
+            return ScopeDecision(True, "out_of_scope_lexicon", probability)
+    if probability is not None and probability >= SCOPE_MODEL_THRESHOLD:
+        return ScopeDecision(True, "model", probability)
+    return ScopeDecision(False, "uncertain", probability)
+
+
+# --- Training From Logged Sessions ---
+def _is_refusal(content: str) -> bool:
+    return "خارج نطاق" in content
+
+
+def _called_expert(data: Dict[str, Any]) -> bool:
+    for message in data.get("messages") or []:
+        for part in message.get("parts", []):
+            if part.get("part_kind") == "tool-call" and part.get("tool_name") == "expert":
+                return True
+    return False
+
+
+def label_sessions(rows: List[Dict[str, Any]]) -> List[Tuple[str, int]]:
+    """Pair each human question with the reply that follows it and label it.
+
+    Replies that called `expert` (or, for rows without a stored run, answered
+    without refusing) are in scope; refusals without a tool call are out of
+    scope. Error replies and refusals made by this classifier are skipped.
+    """
+    samples = []
+    question = None
+    for row in rows:
+        message = row["message"]
+        if message["type"] == "human":
+            question = message["content"]
+            continue
+        data = message.get("data") or {}
+        if question is None or data.get("error") or data.get("scope_classifier"):
+            question = None
+            continue
+        if data.get("messages"):
+            # Retrieve-first runs retrieve without a tool call; answering there means in scope.
+            called = _called_expert(data) or (data.get("mode") == "retrieve_first" and not _is_refusal(message["content"]))
+            if called or _is_refusal(message["content"]):
+                samples.append((canonicalize_arabic(question), 0 if called else 1))
+        else:
+            samples.append((canonicalize_arabic(question), 1 if _is_refusal(message["content"]) else 0))
+        question = None
+    return samples
+
+
+async def _fetch_logged_rows(page_size: int = 1000, max_rows: int = 200000) -> List[Dict[str, Any]]:
+    from Law_agent_storage import get_supabase
+
+    client = await get_supabase()
+    rows: List[Dict[str, Any]] = []
+    while len(rows) < max_rows:
+        response = await client.table("messages") \
+            .select("session_id, message, created_at") \
+            .order("session_id") \
+            .order("created_at") \
+            .range(len(rows), len(rows) + page_size - 1) \
+            .execute()
+        rows.extend(response.data)
+        if len(response.data) < page_size:
+            break
+    return rows
+
+
+def _split_by_session(rows: List[Dict[str, Any]]) -> List[Tuple[str, int]]:
+    samples = []
+    session, current = None, []
+    for row in rows + [{"session_id": object()}]:
+        if row["session_id"] != session:
+            samples.extend(label_sessions(current))
+            session, current = row["session_id"], []
+        if "message" in row:
+            current.append(row)
+    return samples
+
+
+async def train(out: Path, epochs: int):
+    samples = _split_by_session(await _fetch_logged_rows())
+    if not samples:
+        raise SystemExit("No labelled questions found in the messages table.")
+    rng = random.Random(1)
+    rng.shuffle(samples)
+    held_out = samples[: max(1, len(samples) // 10)]
+    model = ScopeModel().fit(samples[len(held_out):], epochs=epochs)
+    correct = sum((model.predict(text) >= 0.5) == bool(label) for text, label in held_out)
+    model.save(out)
+    positives = sum(label for _, label in samples)
+    print(f"Trained on {len(samples) - len(held_out)} questions ({positives} out of scope overall); "
+          f"held-out accuracy {correct / len(held_out):.3f}; saved to {out}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    train_parser = commands.add_parser("train", help="Train the n-gram model from logged sessions.")
+    train_parser.add_argument("--out", type=Path, default=SCOPE_MODEL_PATH)
+    train_parser.add_argument("--epochs", type=int, default=15)
+    classify_parser = commands.add_parser("classify", help="Classify one question.")
+    classify_parser.add_argument("query")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        asyncio.run(train(args.out, args.epochs))
+    else:
+        print(classify_scope(args.query))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+
+@lru_cache(maxsize=1)
+def load_env():
+    """Load `.env` into the environment once per process.
+
+    Every module that reads settings at import calls this first, so the values
+    are there no matter which module a process imports first.
+    """
+    load_dotenv()
@@ -0,0 +1,267 @@
+import asyncio
+import json
+import os
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from pydantic_ai import Agent
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    SystemPromptPart,
+    TextPart,
+    ToolCallPart,
+    UserPromptPart
+)
+
+from Law_agent import model
+from Law_agent_config import load_env
+from Law_agent_storage import (
+    assemble_messages,
+    fetch_session_summary,
+    session_cache,
+    store_session_summary,
+    summaries_available,
+    parse_timestamp
+)
+
+load_env()
+
+# Token budget for the conversation history sent with each request.
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+# tiktoken encoding used for counting; o200k_base is the gpt-4o family tokenizer and
+# splits Arabic far more tightly than the older cl100k_base.
+HISTORY_TOKENIZER = os.getenv("HISTORY_TOKENIZER", "o200k_base")
+
+# Rolling summarization: turns older than the last SUMMARY_KEEP_TURNS are compacted into
+# the session summary once they add up to SUMMARY_TRIGGER_TOKENS (0, the default, disables
+# it). Needs the session_summaries table, see Law_agent_storage.py; e.g. 1500 to turn it on.
+SUMMARY_KEEP_TURNS = int(os.getenv("SUMMARY_KEEP_TURNS", "3"))
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "0"))
+
+# Per-message framing the chat format adds around each message's content.
+_MESSAGE_OVERHEAD = 4
+
+
+@lru_cache(maxsize=1)
+def _encoder() -> Callable[[str], int]:
+    """Return a token counter, using tiktoken when it is installed and its encoding is available."""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding(HISTORY_TOKENIZER)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        # Fallback: Arabic text averages roughly three characters per token. The encoding is
+        # downloaded on first use unless it is already in TIKTOKEN_CACHE_DIR (the image has it).
+        print(f"tiktoken encoding {HISTORY_TOKENIZER} is not available ({str(e)}); "
+              "estimating history tokens from character counts")
+        return lambda text: (len(text) + 2) // 3
+
+
+def count_tokens(text: str) -> int:
+    return _encoder()(text)
+
+
+def _part_text(part) -> str:
+    if isinstance(part, ToolCallPart):
+        args = part.args if isinstance(part.args, str) else json.dumps(part.args, ensure_ascii=False)
+        return f"{part.tool_name}{args}"
+    content = getattr(part, "content", "")
+    return content if isinstance(content, str) else json.dumps(content, ensure_ascii=False, default=str)
+
+
+def message_tokens(message: ModelMessage) -> int:
+    """Approximate prompt tokens a message contributes when it is resent as history."""
+    return _MESSAGE_OVERHEAD + sum(count_tokens(_part_text(part)) for part in message.parts)
+
+
+def _starts_turn(message: ModelMessage) -> bool:
+    return isinstance(message, ModelRequest) and any(isinstance(part, UserPromptPart) for part in message.parts)
+
+
+def split_turns(messages: List[ModelMessage]) -> List[List[ModelMessage]]:
+    """Group messages into turns, each starting at a user prompt.
+
+    Keeping whole turns together guarantees a tool call is never sent without
+    its matching tool return.
+    """
+    turns: List[List[ModelMessage]] = []
+    for message in messages:
+        if not turns or _starts_turn(message):
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _is_summary(message: ModelMessage) -> bool:
+    return isinstance(message, ModelRequest) and all(isinstance(part, SystemPromptPart) for part in message.parts)
+
+
+def _text_only(turn: List[ModelMessage]) -> List[ModelMessage]:
+    """A turn reduced to its user prompt and final answer, without tool calls and returns."""
+    prompt = [part for part in turn[0].parts if isinstance(part, UserPromptPart)]
+    reduced: List[ModelMessage] = [ModelRequest(parts=prompt)]
+    answer = next((message for message in reversed(turn) if isinstance(message, ModelResponse)), None)
+    if answer is not None:
+        text = [part for part in answer.parts if isinstance(part, TextPart)]
+        if text:
+            reduced.append(ModelResponse(parts=text, model_name=answer.model_name, timestamp=answer.timestamp))
+    return reduced
+
+
+def select_history(messages: List[ModelMessage], budget: int = HISTORY_TOKEN_BUDGET) -> Tuple[List[ModelMessage], int]:
+    """Keep the session summary, if any, and the newest turns that fit in `budget` tokens.
+
+    A turn that does not fit whole (usually because of a long expert result) is kept
+    in its text-only form when that fits. Returns the selected messages in
+    chronological order and their token count.
+    """
+    # The summary stands in for every turn older than the stored ones, so it is charged
+    # first and always kept rather than being the first thing dropped.
+    pinned: List[ModelMessage] = []
+    if messages and _is_summary(messages[0]):
+        pinned, messages = messages[:1], messages[1:]
+    selected: List[List[ModelMessage]] = []
+    used = sum(message_tokens(message) for message in pinned)
+    for turn in reversed(split_turns(messages)):
+        tokens = sum(message_tokens(message) for message in turn)
+        if used + tokens > budget and _starts_turn(turn[0]):
+            turn = _text_only(turn)
+            tokens = sum(message_tokens(message) for message in turn)
+        if used + tokens > budget:
+            break
+        selected.append(turn)
+        used += tokens
+    return pinned + [message for turn in reversed(selected) for message in turn], used
+
+
+# --- Rolling Summarization ---
+summary_prompt = """
+You compact the older part of a conversation between a user and a digital legal assistant
+specialised in the Saudi Bankruptcy Law. Write a concise summary in Arabic (at most 200 words)
+that keeps: the user's situation and goals, every legal fact, procedure and article the
+assistant stated, and any question that is still open. If a previous summary is given, merge
+it with the new turns into one summary. Output only the summary.
+"""
+
+summary_agent = Agent(model, instructions=summary_prompt, retries=1)
+
+
+class SummaryStats:
+    """Cost of the summarizer and the prompt tokens its summaries remove."""
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.total_ms = 0.0
+        self.last_ms: Optional[float] = None
+        self.tokens_saved = 0
+        self.last_tokens_saved: Optional[int] = None
+
+    def record(self, elapsed_ms: float, raw_tokens: int, summary_tokens: int):
+        self.runs += 1
+        self.total_ms += elapsed_ms
+        self.last_ms = elapsed_ms
+        self.last_tokens_saved = raw_tokens - summary_tokens
+        self.tokens_saved += self.last_tokens_saved
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "avg_ms": round(self.total_ms / self.runs, 1) if self.runs else None,
+            "last_ms": self.last_ms,
+            # Prompt tokens removed from every later request of the summarized sessions.
+            "tokens_saved": self.tokens_saved,
+            "last_tokens_saved": self.last_tokens_saved,
+        }
+
+
+summary_stats = SummaryStats()
+_summarizing: Set[str] = set()
+_summary_tasks: Set[asyncio.Task] = set()
+
+
+def _entry_turns(entries: List[tuple]) -> List[List[tuple]]:
+    """Group session cache entries into turns, each starting at a human row."""
+    turns: List[List[tuple]] = []
+    for entry in entries:
+        if not turns or entry[1] == "human":
+            turns.append([])
+        turns[-1].append(entry)
+    return turns
+
+
+def render_transcript(messages: List[ModelMessage]) -> str:
+    """Plain-text transcript of the user prompts and assistant replies (tool traffic omitted)."""
+    lines = []
+    for message in messages:
+        for part in message.parts:
+            if isinstance(message, ModelRequest) and isinstance(part, UserPromptPart) and isinstance(part.content, str):
+                lines.append(f"User: {part.content}")
+            elif isinstance(message, ModelResponse) and isinstance(part, TextPart):
+                lines.append(f"Assistant: {part.content}")
+    return "\n\n".join(lines)
+
+
+async def summarize_session(session_id: str):
+    """Fold turns beyond the recent window into the session's stored summary."""
+    summary = await fetch_session_summary(session_id)
+    if not summaries_available():
+        # Without a readable summary a new one would overwrite it, and storing it would likely fail too.
+        return
+    after = parse_timestamp(summary["summarized_until"]) if summary else None
+    entries = [entry for entry in await session_cache.load_entries(session_id) if after is None or entry[0] > after]
+    turns = _entry_turns(entries)
+    older = turns[:-SUMMARY_KEEP_TURNS] if SUMMARY_KEEP_TURNS > 0 else turns
+    if not older:
+        return
+
+    older_messages = assemble_messages([(kind, row_messages) for turn in older for _, kind, row_messages, _ in turn])
+    raw_tokens = sum(message_tokens(message) for message in older_messages)
+    if raw_tokens < SUMMARY_TRIGGER_TOKENS:
+        return
+
+    prompt = f"Conversation:\n{render_transcript(older_messages)}"
+    if summary:
+        raw_tokens += count_tokens(summary["summary"])
+        prompt = f"Previous summary:\n{summary['summary']}\n\n{prompt}"
+
+    start = time.perf_counter()
+    result = await summary_agent.run(prompt)
+    elapsed_ms = round((time.perf_counter() - start) * 1000, 1)
+
+    summary_tokens = count_tokens(result.output)
+    await store_session_summary(
+        session_id,
+        result.output,
+        summarized_until=older[-1][-1][0],
+        raw_tokens=raw_tokens,
+        summary_tokens=summary_tokens
+    )
+    summary_stats.record(elapsed_ms, raw_tokens, summary_tokens)
+
+
+async def _run_summary(session_id: str):
+    try:
+        await summarize_session(session_id)
+    except Exception as e:
+        summary_stats.failures += 1
+        print(f"Failed to summarize session {session_id}: {str(e)}")
+    finally:
+        _summarizing.discard(session_id)
+
+
+def schedule_summary(session_id: str):
+    """Summarize the session in the background, off the request's critical path."""
+    # After a failed summary read or write, no LLM call is spent on a summary until the
+    # backoff has passed.
+    if SUMMARY_TRIGGER_TOKENS <= 0 or session_id in _summarizing or not summaries_available():
+        return
+    _summarizing.add(session_id)
+    # Keep a reference so the task is not garbage collected before it finishes.
+    task = asyncio.create_task(_run_summary(session_id))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
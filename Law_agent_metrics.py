@@ -0,0 +1,194 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Dict, Optional, Tuple, TypeVar
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+from pydantic_ai.messages import ModelResponse
+from pydantic_ai.usage import RunUsage
+
+from Law_agent_tracing import tracer
+
+T = TypeVar("T")
+
+# --- Prometheus Metrics ---
+# Every label takes values from a fixed set in the code (stage names, cache names, HTTP
+# status codes), never from request data, so the number of series stays bounded.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+REQUESTS = Counter("law_agent_requests_total", "Agent requests by outcome.", ["endpoint", "outcome"])
+REQUEST_SECONDS = Histogram(
+    "law_agent_request_seconds", "Total agent request time.", ["endpoint"], buckets=LATENCY_BUCKETS
+)
+STAGE_SECONDS = Histogram(
+    "law_agent_stage_seconds", "Time per pipeline stage of a request.", ["stage"], buckets=LATENCY_BUCKETS
+)
+LLM_REQUEST_SECONDS = Histogram(
+    "law_agent_llm_request_seconds", "Time per model request (streamed ones until the stream ends).",
+    ["kind"], buckets=LATENCY_BUCKETS
+)
+EXPERT_REQUEST_SECONDS = Histogram(
+    "law_agent_expert_request_seconds", "Time per upstream call to the expert endpoint.", buckets=LATENCY_BUCKETS
+)
+DB_SECONDS = Histogram(
+    "law_agent_db_seconds", "Time per Supabase operation.", ["operation"], buckets=LATENCY_BUCKETS
+)
+UPSTREAM_RESPONSES = Counter(
+    "law_agent_upstream_responses_total", "Upstream responses by HTTP status (or error).", ["upstream", "status"]
+)
+CACHE_LOOKUPS = Counter("law_agent_cache_lookups_total", "Cache lookups by result.", ["cache", "result"])
+MESSAGES_DROPPED = Counter(
+    "law_agent_messages_dropped_total", "Message rows the write-behind queue gave up on after every retry."
+)
+ADMISSION_QUEUED = Gauge(
+    "law_agent_admission_queued", "Requests waiting for an agent slot.", multiprocess_mode="livesum"
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "law_agent_admission_in_flight", "Agent runs holding a slot.", multiprocess_mode="livesum"
+)
+
+
+def record_request(endpoint: str, outcome: str, total_ms: float):
+    REQUESTS.labels(endpoint, outcome).inc()
+    REQUEST_SECONDS.labels(endpoint).observe(total_ms / 1000)
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def record_dropped_messages(count: int):
+    MESSAGES_DROPPED.inc(count)
+
+
+@contextmanager
+def track_db(operation: str):
+    """Time a Supabase operation and count it as ok or error."""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        with tracer.start_as_current_span(f"supabase {operation}"):
+            yield
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        DB_SECONDS.labels(operation).observe(time.perf_counter() - start)
+        UPSTREAM_RESPONSES.labels("supabase", status).inc()
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Serialize all metrics in the Prometheus text format.
+
+    With several workers (PROMETHEUS_MULTIPROC_DIR set, see gunicorn.conf.py) the
+    values of every worker are aggregated, not just the one serving the scrape.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+class StageTimer:
+    """Wall-clock milliseconds per pipeline stage of a single request.
+
+    Stages that run concurrently are timed independently, so their sum can
+    exceed `total`; the difference is the time saved by overlapping them.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            with tracer.start_as_current_span(name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = round(elapsed * 1000, 1)
+            STAGE_SECONDS.labels(name).observe(elapsed)
+
+    async def measure(self, name: str, awaitable: Awaitable[T]) -> T:
+        """Await `awaitable`, recording its duration under `name`."""
+        with self.stage(name):
+            return await awaitable
+
+    def snapshot(self) -> Dict[str, float]:
+        """Stages recorded so far plus the time elapsed since the request started."""
+        return {**self.timings, "total": round((time.perf_counter() - self._start) * 1000, 1)}
+
+    def finish(self) -> Dict[str, float]:
+        self.timings = self.snapshot()
+        return self.timings
+
+
+def run_record(result) -> Dict[str, Any]:
+    """Usage and model of an agent run, for the `data` column of the AI message."""
+    usage = run_usage(result)
+    model_name = next(
+        (message.model_name for message in reversed(result.new_messages()) if isinstance(message, ModelResponse)),
+        None
+    )
+    return {
+        "model": model_name,
+        "usage": {
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "cached_tokens": usage.cache_read_tokens,
+            "requests": usage.requests,
+            "tool_calls": usage.tool_calls,
+        },
+    }
+
+
+def run_usage(result) -> RunUsage:
+    """The `RunUsage` of an agent run.
+
+    `usage` is a method up to pydantic-ai 1.106 and a property (still callable, with a
+    deprecation warning) from 1.107 on; this reads it without the warning on both.
+    """
+    usage = result.usage
+    return usage if isinstance(usage, RunUsage) else usage()
+
+
+class PromptCacheStats:
+    """Prompt tokens served from the provider's prompt cache, summed over agent runs."""
+
+    def __init__(self):
+        self.runs = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.last_cached_tokens: Optional[int] = None
+
+    def record(self, usage) -> int:
+        """Add a run's `RunUsage` and return its cached prompt tokens."""
+        self.runs += 1
+        self.input_tokens += usage.input_tokens
+        self.cached_tokens += usage.cache_read_tokens
+        self.last_cached_tokens = usage.cache_read_tokens
+        return usage.cache_read_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "runs": self.runs,
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "hit_ratio": round(self.cached_tokens / self.input_tokens, 3) if self.input_tokens else None,
+            "last_cached_tokens": self.last_cached_tokens,
+        }
+
+
+prompt_cache_stats = PromptCacheStats()
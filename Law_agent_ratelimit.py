@@ -0,0 +1,174 @@
+import math
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict
+
+from Law_agent_config import load_env
+
+load_env()
+
+# Per-user token buckets: RATE_LIMIT_PER_MINUTE requests per minute sustained, bursts of up
+# to RATE_LIMIT_BURST. Set RATE_LIMIT_PER_MINUTE=0 to disable.
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "20"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+# "memory" keeps the buckets in this process; "redis" shares them between workers and hosts.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+# Most users tracked by the memory backend; the least recently seen are dropped first.
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "100000"))
+
+
+@dataclass
+class RateDecision:
+    allowed: bool
+    remaining: int
+    retry_after: int = 0
+
+
+class RateLimiterStats:
+    def __init__(self):
+        self.allowed = 0
+        self.limited = 0
+        self.errors = 0
+
+    def record(self, decision: RateDecision) -> RateDecision:
+        if decision.allowed:
+            self.allowed += 1
+        else:
+            self.limited += 1
+        return decision
+
+
+def _retry_after(tokens: float, rate: float) -> int:
+    """Whole seconds until a bucket holding `tokens` has refilled to one token."""
+    return max(1, math.ceil((1 - tokens) / rate))
+
+
+class MemoryRateLimiter:
+    """Token buckets in a process-local dict; O(1) per check with no I/O.
+
+    Each worker process keeps its own buckets, so with N workers a user can get up
+    to N times the configured rate. Use RedisRateLimiter when that matters.
+    """
+
+    backend = "memory"
+
+    def __init__(self, per_minute: float, burst: int, max_users: int = RATE_LIMIT_MAX_USERS):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_users = max_users
+        # user_id -> (tokens, last refill time), least recently seen first.
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()
+        self.counters = RateLimiterStats()
+
+    async def allow(self, key: str) -> RateDecision:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            decision = RateDecision(True, int(tokens))
+        else:
+            decision = RateDecision(False, 0, _retry_after(tokens, self.rate))
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        return self.counters.record(decision)
+
+    async def close(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "users": len(self._buckets),
+            "allowed": self.counters.allowed,
+            "limited": self.counters.limited,
+        }
+
+
+# Refill and take one token atomically. Redis' own clock is used so every worker agrees on
+# elapsed time; the key expires once an idle bucket would be full again anyway.
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisRateLimiter:
+    """Token buckets shared through Redis, for multi-worker and multi-host deployments.
+
+    One round trip per check. If Redis is unreachable the request is let through,
+    so an outage of the limiter never takes the agent down with it.
+    """
+
+    backend = "redis"
+
+    def __init__(self, url: str, per_minute: float, burst: int, prefix: str = "law-agent:ratelimit:"):
+        import redis.asyncio as redis
+
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.prefix = prefix
+        self._redis = redis.from_url(url)
+        self._script = self._redis.register_script(_TOKEN_BUCKET_SCRIPT)
+        self.counters = RateLimiterStats()
+
+    async def allow(self, key: str) -> RateDecision:
+        try:
+            allowed, tokens = await self._script(keys=[self.prefix + key], args=[self.rate, self.burst])
+        except Exception as e:
+            self.counters.errors += 1
+            print(f"Rate limiter unavailable, allowing request: {str(e)}")
+            return RateDecision(True, self.burst)
+        tokens = float(tokens)
+        if allowed:
+            return self.counters.record(RateDecision(True, int(tokens)))
+        return self.counters.record(RateDecision(False, 0, _retry_after(tokens, self.rate)))
+
+    async def close(self):
+        await self._redis.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "allowed": self.counters.allowed,
+            "limited": self.counters.limited,
+            "errors": self.counters.errors,
+        }
+
+
+def create_rate_limiter():
+    """Build the configured limiter, or None when rate limiting is disabled.
+
+    Any object with `async allow(key) -> RateDecision`, `async close()` and `stats()`
+    can stand in for another shared backend.
+    """
+    if RATE_LIMIT_PER_MINUTE <= 0:
+        return None
+    if RATE_LIMIT_BACKEND == "redis":
+        try:
+            return RedisRateLimiter(RATE_LIMIT_REDIS_URL, RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST)
+        except ImportError:
+            # The shared backend needs the optional `redis` package (pip install redis).
+            print("RATE_LIMIT_BACKEND is redis but the 'redis' package is not installed; using per-process buckets")
+    return MemoryRateLimiter(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST)
+
+
+rate_limiter = create_rate_limiter()
@@ -0,0 +1,594 @@
+import asyncio
+import os
+import time
+from dataclasses import replace
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, List, Optional, Dict, Any, Tuple
+
+from fastapi import HTTPException
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    SystemPromptPart,
+    UserPromptPart,
+    TextPart
+)
+
+from Law_agent_cache import TTLCache
+from Law_agent_config import load_env
+from Law_agent_metrics import record_cache_lookup, record_dropped_messages, track_db
+
+if TYPE_CHECKING:
+    from supabase import AsyncClient
+
+# Load environment variables
+load_env()
+
+# Write-behind settings for message inserts.
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "50"))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.25"))
+MESSAGE_QUEUE_MAX = int(os.getenv("MESSAGE_QUEUE_MAX", "5000"))
+MESSAGE_ENQUEUE_TIMEOUT = float(os.getenv("MESSAGE_ENQUEUE_TIMEOUT", "5"))
+MESSAGE_FLUSH_RETRIES = int(os.getenv("MESSAGE_FLUSH_RETRIES", "3"))
+
+# Per-session conversation cache (set SESSION_CACHE_MAX_SESSIONS=0 to disable). It is only
+# correct while every request of a session reaches this process, so gunicorn.conf.py turns
+# it off by default when running several workers.
+# Upper bound on rows read per session; the prompt window itself is chosen by token budget.
+HISTORY_MAX_ROWS = int(os.getenv("HISTORY_MAX_ROWS", "40"))
+SESSION_CACHE_MAX_SESSIONS = int(os.getenv("SESSION_CACHE_MAX_SESSIONS", "2000"))
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "900"))
+
+# --- Supabase Client ---
+# Optimization: The async client awaits every round trip, so a slow query only
+# suspends the request that issued it instead of stalling the whole event loop.
+_supabase: Optional["AsyncClient"] = None
+_supabase_lock = asyncio.Lock()
+
+
+async def get_supabase() -> "AsyncClient":
+    """Return the shared async Supabase client, creating it on first use."""
+    global _supabase
+    if _supabase is None:
+        async with _supabase_lock:
+            if _supabase is None:
+                # Imported here: the supabase package and its sub-clients are slow to import
+                # and only needed once the first query runs.
+                from supabase import acreate_client
+
+                _supabase = await acreate_client(
+                    os.getenv("SUPABASE_URL"),
+                    os.getenv("SUPABASE_SERVICE_KEY")
+                )
+    return _supabase
+
+
+def parse_timestamp(value: Any) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+# --- Write-Behind Message Queue ---
+_STOP = object()
+
+
+class MessageWriter:
+    """Background write-behind queue that persists message rows as bulk inserts.
+
+    Rows are flushed when `batch_size` rows are waiting or `flush_interval`
+    seconds after the first row of a batch arrived, whichever comes first.
+    The queue is bounded: when it is full, `put` waits up to `enqueue_timeout`
+    seconds for space (backpressure) before failing. `close` flushes every
+    queued row before returning.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = MESSAGE_BATCH_SIZE,
+        flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+        max_queue: int = MESSAGE_QUEUE_MAX,
+        enqueue_timeout: float = MESSAGE_ENQUEUE_TIMEOUT,
+        max_retries: int = MESSAGE_FLUSH_RETRIES,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.enqueue_timeout = enqueue_timeout
+        self.max_retries = max_retries
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Rows accepted but not yet flushed, so a session still reads its own writes.
+        self._pending: Dict[str, List[Dict[str, Any]]] = {}
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failed_rows = 0
+        self.backpressure_waits = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if not self.running:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Flush every queued row and stop the background task."""
+        if not self.running:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def put(self, row: Dict[str, Any]):
+        if self._queue.full():
+            self.backpressure_waits += 1
+        pending = self._pending.setdefault(row["session_id"], [])
+        pending.append(row)
+        try:
+            await asyncio.wait_for(self._queue.put(row), timeout=self.enqueue_timeout)
+        except BaseException:
+            self._forget(row)
+            raise
+
+    def _forget(self, row: Dict[str, Any]):
+        rows = self._pending.get(row["session_id"])
+        if rows is not None:
+            rows.remove(row)
+            if not rows:
+                del self._pending[row["session_id"]]
+
+    def pending_for(self, session_id: str) -> List[Dict[str, Any]]:
+        return list(self._pending.get(session_id, ()))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Dict[str, Any]]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                client = await get_supabase()
+                with track_db("messages_insert_batch"):
+                    await client.table("messages").insert(batch).execute()
+                self.flushes += 1
+                self.flushed_rows += len(batch)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    print(f"Failed to flush {len(batch)} messages after {attempt + 1} attempts: {str(e)}")
+                    await self._flush_rows(batch)
+                else:
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+        for row in batch:
+            self._forget(row)
+
+    async def _flush_rows(self, batch: List[Dict[str, Any]]):
+        """Insert a failed batch row by row, so one bad row does not drop the others."""
+        failed = 0
+        for row in batch:
+            try:
+                client = await get_supabase()
+                with track_db("messages_insert"):
+                    await client.table("messages").insert(row).execute()
+                self.flushed_rows += 1
+            except Exception as e:
+                failed += 1
+                print(f"Dropped message for session {row['session_id']}: {str(e)}")
+        if failed:
+            self.failed_rows += failed
+            record_dropped_messages(failed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "failed_rows": self.failed_rows,
+            "backpressure_waits": self.backpressure_waits,
+        }
+
+
+# Started and closed by the endpoint's lifespan hook; when it is not running,
+# store_message falls back to a direct insert.
+message_writer = MessageWriter()
+
+
+async def fetch_conversation_history(
+    session_id: str,
+    limit: int = 10,
+    before: Optional[datetime] = None
+) -> List[Dict[str, Any]]:
+    """Fetch the most recent conversation history for a session.
+
+    When `before` is given, only messages created before that instant are
+    returned, so a message stored concurrently by the same request is excluded.
+    """
+    try:
+        client = await get_supabase()
+        query = client.table("messages") \
+            .select("*") \
+            .eq("session_id", session_id)
+        if before is not None:
+            query = query.lt("created_at", before.isoformat())
+        with track_db("messages_select"):
+            response = await query \
+                .order("created_at", desc=True) \
+                .limit(limit) \
+                .execute()
+
+        # Convert to list and reverse to get chronological order
+        messages = response.data[::-1]
+
+        # Append rows still waiting in the write-behind queue (skipping any that
+        # were flushed while this query ran) so a session always sees its own writes.
+        pending = message_writer.pending_for(session_id)
+        if before is not None:
+            pending = [row for row in pending if parse_timestamp(row["created_at"]) < before]
+        if pending:
+            stored = {parse_timestamp(row.get("created_at")) for row in messages}
+            messages.extend(row for row in pending if parse_timestamp(row["created_at"]) not in stored)
+            messages = messages[-limit:]
+        return messages
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch conversation history: {str(e)}")
+
+
+async def store_message(session_id: str, message_type: str, content: str, data: Optional[Dict] = None):
+    """Store a message in the Supabase messages table."""
+    message_obj = {
+        "type": message_type,
+        "content": content
+    }
+    if data:
+        message_obj["data"] = data
+
+    row = {
+        "session_id": session_id,
+        "message": message_obj,
+        # Set client-side so rows in one bulk insert keep their order.
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+    try:
+        # Optimization: Rows are handed to the write-behind queue and bulk-inserted in the
+        # background, so request latency no longer includes the database write.
+        if message_writer.running:
+            await message_writer.put(row)
+        else:
+            client = await get_supabase()
+            with track_db("messages_insert"):
+                await client.table("messages").insert(row).execute()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to store message: {str(e)}")
+
+    session_cache.append(session_id, row)
+
+
+# --- Session Conversation Cache ---
+def row_kind(row: Dict[str, Any]) -> str:
+    """Classify a row as "human", "ai" (reply text only) or "turn" (complete stored run)."""
+    msg_data = row["message"]
+    if msg_data["type"] == "human":
+        return "human"
+    return "turn" if (msg_data.get("data") or {}).get("messages") else "ai"
+
+
+def strip_static_prompt(messages: List[ModelMessage]) -> List[ModelMessage]:
+    """Drop the agent's static prompt from a run's messages.
+
+    The agent sends its instructions itself as the first message of every request, so
+    a copy kept in history would only be resent further down and break the cacheable
+    prefix. Older rows carry it as a SystemPromptPart, newer ones as `instructions`.
+    """
+    stripped = []
+    for message in messages:
+        if isinstance(message, ModelRequest):
+            parts = [part for part in message.parts if not isinstance(part, SystemPromptPart)]
+            if not parts:
+                continue
+            message = replace(message, parts=parts, instructions=None)
+        stripped.append(message)
+    return stripped
+
+
+def dump_messages(messages: List[ModelMessage]) -> List[Dict[str, Any]]:
+    """Serialize a run for `data.messages`, without the static prompt."""
+    return ModelMessagesTypeAdapter.dump_python(strip_static_prompt(messages), mode="json")
+
+
+def row_to_messages(row: Dict[str, Any]) -> List[ModelMessage]:
+    """Convert one Supabase message row to the format expected by the agent."""
+    msg_data = row["message"]
+    kind = row_kind(row)
+    if kind == "turn":
+        # The complete run, including `expert` tool calls and returns, exactly as the agent produced it.
+        return strip_static_prompt(ModelMessagesTypeAdapter.validate_python(msg_data["data"]["messages"]))
+    if kind == "human":
+        return [ModelRequest(parts=[UserPromptPart(content=msg_data["content"])])]
+    return [ModelResponse(parts=[TextPart(content=msg_data["content"])])]
+
+
+def assemble_messages(rows: List[Tuple[str, List[ModelMessage]]]) -> List[ModelMessage]:
+    """Join converted (kind, messages) rows into one chronological message history.
+
+    A stored turn already starts with the user's prompt, so the separate human
+    row that precedes it is dropped instead of being sent twice.
+    """
+    messages: List[ModelMessage] = []
+    pending_human: List[ModelMessage] = []
+    for kind, row_messages in rows:
+        if kind == "turn":
+            pending_human = []
+        messages.extend(pending_human)
+        pending_human = []
+        if kind == "human":
+            pending_human = row_messages
+        else:
+            messages.extend(row_messages)
+    messages.extend(pending_human)
+    return messages
+
+
+def history_to_messages(conversation_history: List[Dict[str, Any]]) -> List[ModelMessage]:
+    """Convert Supabase message rows to the format expected by the agent."""
+    return assemble_messages([(row_kind(row), row_to_messages(row)) for row in conversation_history])
+
+
+def _entries_size(session_id: str, entries: List[tuple]) -> int:
+    return len(session_id) + sum(entry[3] for entry in entries)
+
+
+class SessionCache:
+    """Bounded LRU of converted pydantic-ai messages per session, kept current write-through.
+
+    Each entry holds the last `max_rows` rows of a session as
+    (created_at, kind, messages, size) tuples. `store_message` appends to an entry
+    that is already cached; a session that is not cached is loaded once with
+    `fetch_conversation_history`. Rows stored while that load is in flight are
+    buffered and merged into the loaded entry so no write is lost.
+    """
+
+    def __init__(self, max_sessions: int, max_bytes: int, ttl: float, max_rows: int):
+        self.max_rows = max_rows
+        self.enabled = max_sessions > 0
+        self.cache = TTLCache(max_bytes=max_bytes, ttl=ttl, max_entries=max_sessions, sizeof=_entries_size)
+        self._loading: Dict[str, List[tuple]] = {}
+        self.new_sessions = 0
+
+    @staticmethod
+    def _entry(row: Dict[str, Any]) -> tuple:
+        return (parse_timestamp(row["created_at"]), row_kind(row), row_to_messages(row), len(str(row["message"])))
+
+    def append(self, session_id: str, row: Dict[str, Any]):
+        if not self.enabled:
+            return
+        if session_id in self._loading:
+            self._loading[session_id].append(self._entry(row))
+        entries = self.cache.peek(session_id)
+        if entries is not None:
+            self.cache.set(session_id, (entries + [self._entry(row)])[-self.max_rows:])
+
+    async def load_entries(self, session_id: str) -> List[tuple]:
+        """Return the session's cached entries, reading Supabase without caching on a miss."""
+        entries = self.cache.peek(session_id) if self.enabled else None
+        if entries is None:
+            entries = [self._entry(row) for row in await fetch_conversation_history(session_id, self.max_rows)]
+        return entries
+
+    async def session_entries(
+        self,
+        session_id: str,
+        before: Optional[datetime] = None,
+        new_session: bool = False
+    ) -> List[tuple]:
+        """Return the session's entries, reading Supabase only on a miss and caching the result."""
+        if not self.enabled:
+            if new_session:
+                # The client created this session for this turn, so there is nothing to read.
+                self.new_sessions += 1
+                return []
+            return [self._entry(row) for row in await fetch_conversation_history(session_id, self.max_rows, before)]
+
+        entries = self.cache.get(session_id)
+        record_cache_lookup("session", entries is not None)
+        if entries is None:
+            if new_session:
+                self.new_sessions += 1
+                entries = []
+            else:
+                buffered = self._loading.setdefault(session_id, [])
+                try:
+                    rows = await fetch_conversation_history(session_id, self.max_rows)
+                finally:
+                    if self._loading.get(session_id) is buffered:
+                        del self._loading[session_id]
+                entries = [self._entry(row) for row in rows]
+                loaded = {entry[0] for entry in entries}
+                entries.extend(entry for entry in buffered if entry[0] not in loaded)
+                entries.sort(key=lambda entry: entry[0])
+                entries = entries[-self.max_rows:]
+            self.cache.set(session_id, entries)
+        return entries
+
+    @staticmethod
+    def to_messages(
+        entries: List[tuple],
+        before: Optional[datetime] = None,
+        after: Optional[datetime] = None
+    ) -> List[ModelMessage]:
+        """Assemble the messages of the entries created between `after` and `before`."""
+        return assemble_messages([
+            (kind, row_messages)
+            for created_at, kind, row_messages, _ in entries
+            if (before is None or created_at < before) and (after is None or created_at > after)
+        ])
+
+    async def load(
+        self,
+        session_id: str,
+        before: Optional[datetime] = None,
+        after: Optional[datetime] = None,
+        new_session: bool = False
+    ) -> List[ModelMessage]:
+        """Return the session's messages created between `after` and `before`, reading Supabase only on a miss."""
+        return self.to_messages(await self.session_entries(session_id, before, new_session), before, after)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.cache.stats()
+        stats["new_sessions"] = self.new_sessions
+        return stats
+
+
+session_cache = SessionCache(
+    max_sessions=SESSION_CACHE_MAX_SESSIONS,
+    max_bytes=SESSION_CACHE_MAX_BYTES,
+    ttl=SESSION_CACHE_TTL,
+    max_rows=HISTORY_MAX_ROWS,
+)
+
+
+# --- Session Summaries ---
+# Older turns of long sessions are compacted into one summary per session, kept in:
+#
+#   create table session_summaries (
+#       session_id text primary key,
+#       summary text not null,
+#       summarized_until timestamptz not null,
+#       raw_tokens integer,
+#       summary_tokens integer,
+#       updated_at timestamptz not null default now()
+#   );
+# Seconds summaries are not read or written after a failed read or write (e.g. the table
+# does not exist), so each request does not pay, and log, the same failing round trip.
+SUMMARY_RETRY_SECONDS = float(os.getenv("SUMMARY_RETRY_SECONDS", "300"))
+_summaries_down_until = 0.0
+
+
+def summaries_available() -> bool:
+    """False while the summary table is backing off after a failure."""
+    return time.monotonic() >= _summaries_down_until
+
+
+def _summaries_failed(action: str, error: Exception):
+    global _summaries_down_until
+    _summaries_down_until = time.monotonic() + SUMMARY_RETRY_SECONDS
+    print(f"Failed to {action} session summary, not retrying for {SUMMARY_RETRY_SECONDS:.0f}s: {str(error)}")
+
+
+summary_cache = TTLCache(
+    max_bytes=SESSION_CACHE_MAX_BYTES if SESSION_CACHE_MAX_SESSIONS > 0 else 0,
+    ttl=SESSION_CACHE_TTL,
+    max_entries=SESSION_CACHE_MAX_SESSIONS,
+)
+
+
+async def fetch_session_summary(session_id: str) -> Optional[Dict[str, Any]]:
+    """Return the session's stored summary row, or None if it has none.
+
+    A failed read (e.g. no session_summaries table) is treated as no summary: the
+    turn then goes ahead with its recent history only.
+    """
+    summary = summary_cache.get(session_id)
+    if summary is None:
+        if not summaries_available():
+            return None
+        try:
+            client = await get_supabase()
+            with track_db("summary_select"):
+                response = await client.table("session_summaries") \
+                    .select("summary, summarized_until") \
+                    .eq("session_id", session_id) \
+                    .limit(1) \
+                    .execute()
+        except Exception as e:
+            _summaries_failed("fetch", e)
+            return None
+        # An empty dict records that the session has no summary yet.
+        summary = response.data[0] if response.data else {}
+        summary_cache.set(session_id, summary)
+    return summary or None
+
+
+async def store_session_summary(
+    session_id: str,
+    summary: str,
+    summarized_until: datetime,
+    raw_tokens: int,
+    summary_tokens: int
+):
+    """Insert or replace the session's summary."""
+    row = {
+        "session_id": session_id,
+        "summary": summary,
+        "summarized_until": summarized_until.isoformat(),
+        "raw_tokens": raw_tokens,
+        "summary_tokens": summary_tokens,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+    client = await get_supabase()
+    try:
+        with track_db("summary_upsert"):
+            await client.table("session_summaries").upsert(row, on_conflict="session_id").execute()
+    except Exception as e:
+        _summaries_failed("store", e)
+        raise
+    summary_cache.set(session_id, {"summary": summary, "summarized_until": row["summarized_until"]})
+
+
+def summary_message(summary: str) -> ModelRequest:
+    return ModelRequest(parts=[SystemPromptPart(content=f"Summary of the earlier conversation in this session:\n{summary}")])
+
+
+async def load_session_history(
+    session_id: str,
+    before: Optional[datetime] = None,
+    new_session: bool = False,
+    summaries: bool = True
+) -> List[ModelMessage]:
+    """Return the session's recent conversation as pydantic-ai messages.
+
+    If older turns have been summarized, the history is the summary followed by
+    the turns stored after it. With `summaries` False the summary is not read.
+    """
+    # Optimization: Follow-up turns are served from the in-process cache, already converted,
+    # instead of re-querying Supabase and rebuilding ModelRequest/ModelResponse objects.
+    entries = session_cache.session_entries(session_id, before=before, new_session=new_session)
+    if summaries and not new_session:
+        # Optimization: The summary and the turns are read concurrently; the summary's
+        # cutoff is applied to the turns afterwards.
+        summary, entries = await asyncio.gather(fetch_session_summary(session_id), entries)
+    else:
+        summary, entries = None, await entries
+    after = parse_timestamp(summary["summarized_until"]) if summary else None
+
+    messages = session_cache.to_messages(entries, before=before, after=after)
+    if summary:
+        messages = [summary_message(summary["summary"])] + messages
+    return messages
@@ -0,0 +1,230 @@
+"""
+Opt-in OpenTelemetry tracing for the law agent.
+
+With TRACING_EXPORTER set, every request produces one span tree:
+
+    LAW_agent_endpoint (request_id, session_id)
+    ├── store_user_message ── supabase messages_insert
+    ├── history_fetch ── supabase messages_select / summary_select
+    ├── agent_run ── agent run ── chat <model> ── running tool expert ── expert POST
+    └── store_ai_message
+
+Stages come from StageTimer, Supabase spans from track_db, and the agent, model and
+tool spans from pydantic-ai's own instrumentation. Exporters:
+
+- file: one JSON span per line in TRACING_FILE, for offline analysis without a backend.
+- otlp: OTLP/HTTP to OTEL_EXPORTER_OTLP_ENDPOINT (needs opentelemetry-exporter-otlp-proto-http).
+
+Both need the opentelemetry-sdk package. When tracing is off the spans go to the
+no-op tracer of opentelemetry-api, which pydantic-ai already depends on.
+
+Usage:
+    TRACING_EXPORTER=file python Law_agent_Endpoint.py
+    python Law_agent_tracing.py analyze traces/law-agent-*.jsonl --top 5
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import functools
+import glob
+import json
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from opentelemetry import trace
+
+from Law_agent_config import load_env
+
+load_env()
+
+# "none" (default), "file" or "otlp".
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none").lower()
+# File exporter target; {pid} keeps the workers of a multi-process server in separate files.
+TRACING_FILE = os.getenv("TRACING_FILE", "traces/law-agent-{pid}.jsonl")
+# Record prompts and model outputs on the model spans. Off by default: they hold user data.
+TRACING_INCLUDE_CONTENT = os.getenv("TRACING_INCLUDE_CONTENT", "false").lower() in ("1", "true", "yes")
+
+tracer = trace.get_tracer("law_agent")
+_provider = None
+
+
+def setup_tracing() -> bool:
+    """Install the configured exporter for this process; returns whether tracing is on.
+
+    Called from the lifespan hook, i.e. after gunicorn forks, because the batch
+    span processor runs its own export thread.
+    """
+    global _provider
+    if TRACING_EXPORTER in ("", "none") or _provider is not None:
+        return _provider is not None
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+        if TRACING_EXPORTER == "file":
+            path = TRACING_FILE.format(pid=os.getpid())
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            exporter = ConsoleSpanExporter(
+                out=open(path, "a", encoding="utf-8"),
+                formatter=lambda span: span.to_json(indent=None) + "\n"
+            )
+        elif TRACING_EXPORTER == "otlp":
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            exporter = OTLPSpanExporter()
+        else:
+            print(f"Unknown TRACING_EXPORTER {TRACING_EXPORTER!r}; tracing is off")
+            return False
+    except ImportError as e:
+        print(f"TRACING_EXPORTER is {TRACING_EXPORTER} but its package is not installed ({e.name}); tracing is off")
+        return False
+
+    from pydantic_ai import Agent
+    from pydantic_ai.models.instrumented import InstrumentationSettings
+
+    provider = TracerProvider(resource=Resource.create({"service.name": "law-agent"}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    Agent.instrument_all(InstrumentationSettings(tracer_provider=provider, include_content=TRACING_INCLUDE_CONTENT))
+    _provider = provider
+    return True
+
+
+def shutdown_tracing():
+    """Flush spans still buffered in the batch processor."""
+    if _provider is not None:
+        _provider.shutdown()
+
+
+def request_attributes(request) -> Dict[str, Any]:
+    return {"request_id": request.request_id, "session_id": request.session_id}
+
+
+@contextmanager
+def request_span(name: str, request):
+    """Root span of one agent request."""
+    with tracer.start_as_current_span(name, attributes=request_attributes(request)) as span:
+        yield span
+
+
+def traced_request(name: str):
+    """Decorate an endpoint taking an AgentRequest so its whole run is one request span."""
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request, *args, **kwargs):
+            with request_span(name, request):
+                return await endpoint(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def traced_stream(name: str, request, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Keep the request span open while a streaming response is being produced."""
+    with request_span(name, request):
+        async for chunk in stream:
+            yield chunk
+
+
+# --- Offline Critical-Path Analysis ---
+def _load_spans(patterns: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    traces: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        span = json.loads(line)
+                        span["start"] = datetime.fromisoformat(span["start_time"])
+                        span["end"] = datetime.fromisoformat(span["end_time"])
+                        traces[span["context"]["trace_id"]].append(span)
+    return traces
+
+
+def _ms(span: Dict[str, Any]) -> float:
+    return (span["end"] - span["start"]).total_seconds() * 1000
+
+
+def _critical_children(span: Dict[str, Any], children: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Children on the span's critical path, in chronological order.
+
+    Starts from the child that finishes last and walks back to the child that finishes
+    last before it started, and so on; children overlapping a chosen one ran in its
+    shadow and did not delay the span.
+    """
+    chain: List[Dict[str, Any]] = []
+    for child in sorted(children, key=lambda child: (child["end"], child["start"]), reverse=True):
+        if not chain or child["end"] <= chain[-1]["start"]:
+            chain.append(child)
+    return chain[::-1]
+
+
+def critical_path(spans: List[Dict[str, Any]]) -> List[Tuple[int, Dict[str, Any], float]]:
+    """(depth, span, self ms) for every span on the request's critical path, depth first.
+
+    Rooted at the agent's request span, so framework spans around it (e.g. FastAPI's
+    `POST ...`) are left out; self time is what the span spent outside its critical children.
+    Empty for a trace without a request span, e.g. one that only holds a background summary.
+    """
+    children: Dict[Optional[str], List[Dict[str, Any]]] = defaultdict(list)
+    for span in spans:
+        children[span.get("parent_id")].append(span)
+    roots = [span for span in spans if span["name"].startswith("LAW_agent")]
+    if not roots:
+        return []
+    path: List[Tuple[int, Dict[str, Any], float]] = []
+
+    def walk(span: Dict[str, Any], depth: int):
+        chain = _critical_children(span, children.get(span["context"]["span_id"], []))
+        path.append((depth, span, max(_ms(span) - sum(_ms(child) for child in chain), 0.0)))
+        for child in chain:
+            walk(child, depth + 1)
+
+    walk(max(roots, key=_ms), 0)
+    return path
+
+
+def analyze(patterns: List[str], top: int):
+    traces = _load_spans(patterns)
+    if not traces:
+        raise SystemExit("No spans found.")
+    paths = [path for path in map(critical_path, traces.values()) if path]
+    if not paths:
+        raise SystemExit(f"None of the {len(traces)} traces has a LAW_agent request span.")
+    if len(paths) < len(traces):
+        print(f"Skipped {len(traces) - len(paths)} traces without a LAW_agent request span.")
+    paths.sort(key=lambda path: _ms(path[0][1]), reverse=True)
+
+    # Self time of each span name on the critical path, i.e. the time it alone delayed the request.
+    self_ms: Dict[str, float] = defaultdict(float)
+    for path in paths:
+        for _, span, ms in path:
+            self_ms[span["name"]] += ms
+    total = sum(self_ms.values()) or 1.0
+    print(f"{len(paths)} traces; critical-path time by span (self time):")
+    for name, ms in sorted(self_ms.items(), key=lambda item: item[1], reverse=True):
+        print(f"  {ms / len(paths):>9.1f} ms/request  {ms / total:>6.1%}  {name}")
+
+    for path in paths[:top]:
+        root = path[0][1]
+        attributes = root.get("attributes", {})
+        print(f"\n{_ms(root):.0f} ms  request_id={attributes.get('request_id')} session_id={attributes.get('session_id')}")
+        for depth, span, ms in path:
+            offset = (span["start"] - root["start"]).total_seconds() * 1000
+            print(f"  {'  ' * depth}{span['name']}  +{offset:.0f} ms, {_ms(span):.0f} ms (self {ms:.0f} ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    analyze_parser = commands.add_parser("analyze", help="Critical path of traces written by the file exporter.")
+    analyze_parser.add_argument("files", nargs="+")
+    analyze_parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+    analyze(args.files, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Before/after latency comparison for the `expert` tool call.
+
+- per-request client: a fresh httpx.AsyncClient per call (the old endpoint behaviour),
+  so every call pays DNS, TCP and TLS setup to the LightRAG host.
+- shared client:      one pooled client from create_expert_client(), reused across calls
+  the way the lifespan-managed ExpertDeps is.
+
+The LightRAG host, API key and pool settings are taken from the same environment
+variables the agent uses (EXPERT_API_URL, EXPERT_API_KEY, EXPERT_HTTP_*).
+
+Usage:
+    python benchmarks/bench_expert_client.py --calls 20
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+
+# Add parent directory to Python path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from Law_agent import ExpertDeps, create_expert_client, expert
+
+QUERY = "إجراءات التصفية الإدارية في نظام الإفلاس"
+
+
+async def _timed_call(deps: ExpertDeps) -> float:
+    start = time.perf_counter()
+    await expert(SimpleNamespace(deps=deps), QUERY)
+    return (time.perf_counter() - start) * 1000
+
+
+async def per_request_client(calls: int) -> list[float]:
+    timings = []
+    for _ in range(calls):
+        async with httpx.AsyncClient() as client:
+            timings.append(await _timed_call(ExpertDeps(client=client, expert_api_key=os.getenv("EXPERT_API_KEY"))))
+    return timings
+
+
+async def shared_client(calls: int) -> list[float]:
+    async with create_expert_client() as client:
+        deps = ExpertDeps(client=client, expert_api_key=os.getenv("EXPERT_API_KEY"))
+        # Warm the pool once so the numbers reflect steady state.
+        await _timed_call(deps)
+        return [await _timed_call(deps) for _ in range(calls)]
+
+
+def _report(name: str, timings: list[float]):
+    ordered = sorted(timings)
+    p95 = ordered[max(0, int(len(ordered) * 0.95) - 1)]
+    print(f"{name:<20} mean={statistics.mean(timings):8.1f} ms  "
+          f"p50={statistics.median(timings):8.1f} ms  p95={p95:8.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20)
+    args = parser.parse_args()
+
+    _report("per-request client", await per_request_client(args.calls))
+    _report("shared client", await shared_client(args.calls))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+"""
+Measure what persisting the full pydantic-ai message history saves per session.
+
+Runs the same scripted multi-turn session against the live agent twice:
+
+- text: history rebuilt from the stored reply text only (how rows were stored before),
+        so every earlier `expert` result is lost between turns.
+- full: history rebuilt from the stored run (`data.messages`), tool calls and returns included.
+
+For each mode it reports the `expert` calls, model requests and input/output tokens
+summed over the session, from each run's usage. Needs the same environment as the
+agent itself (OPEN_ROUTER_API_KEY or OPENAI_API_KEY, EXPERT_API_KEY).
+
+Usage:
+    python benchmarks/bench_history_replay.py
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Add parent directory to Python path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from Law_agent import ExpertDeps, create_expert_client, expert_agent
+from Law_agent_metrics import run_usage
+from Law_agent_storage import dump_messages, history_to_messages
+
+SESSION = [
+    "ما هي إجراءات التصفية الإدارية في نظام الإفلاس السعودي؟",
+    "ومن الذي يتولى حصر أصول المدين فيها؟",
+    "وكيف يتم ترتيب الدائنين عند توزيع العائدات؟",
+    "لخص لي الخطوات اللي ذكرتها في نقاط.",
+]
+
+
+def _row(message_type: str, content: str, data: dict | None = None) -> dict:
+    message = {"type": message_type, "content": content}
+    if data:
+        message["data"] = data
+    return {"message": message, "created_at": datetime.now(timezone.utc).isoformat()}
+
+
+async def run_session(deps: ExpertDeps, full_history: bool) -> dict:
+    rows: list[dict] = []
+    totals = {"expert_calls": 0, "requests": 0, "input_tokens": 0, "output_tokens": 0}
+    for question in SESSION:
+        result = await expert_agent.run(question, message_history=history_to_messages(rows[-10:]), deps=deps)
+        usage = run_usage(result)
+        totals["expert_calls"] += usage.tool_calls
+        totals["requests"] += usage.requests
+        totals["input_tokens"] += usage.input_tokens
+        totals["output_tokens"] += usage.output_tokens
+
+        data = {}
+        if full_history:
+            data["messages"] = dump_messages(result.new_messages())
+        rows.append(_row("human", question))
+        rows.append(_row("ai", result.output, data))
+    return totals
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    async with create_expert_client() as client:
+        deps = ExpertDeps(client=client, expert_api_key=os.getenv("EXPERT_API_KEY"))
+        text = await run_session(deps, full_history=False)
+        full = await run_session(deps, full_history=True)
+
+    print(f"{len(SESSION)}-turn session")
+    print(f"{'':<14} | {'text history':>12} | {'full history':>12} | {'saved':>8}")
+    print("-" * 56)
+    for key in text:
+        print(f"{key:<14} | {text[key]:>12} | {full[key]:>12} | {text[key] - full[key]:>8}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,272 @@
+"""
+Micro-benchmarks of the per-request Python work in the endpoint and the agent.
+
+Covers, at realistic history sizes and answer lengths:
+
+- history:  Supabase rows -> ModelRequest/ModelResponse (history_to_messages) and
+            token-budget selection (select_history).
+- request:  AgentRequest validation from the raw JSON body.
+- expert:   query_expert request/response handling over an in-process transport,
+            and a lookup_expert cache hit.
+- encode:   dump_messages of a finished run, the JSON of the stored row, the
+            AgentResponse body and one SSE token event.
+
+Timings are per call; each benchmark runs `--rounds` rounds of enough calls to last
+`--min-round-ms`. Results are written in pytest-benchmark's JSON layout, so they also
+load in `pytest-benchmark compare`. `--compare` prints the median change against an
+earlier file and exits 1 when a benchmark is slower by more than `--fail-above` percent.
+
+Usage:
+    python benchmarks/bench_hot_paths.py --save before.json
+    python benchmarks/bench_hot_paths.py --save after.json --compare before.json
+    python benchmarks/bench_hot_paths.py --filter history
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+from pydantic_ai.messages import (
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+
+# Add parent directory to Python path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from Law_agent import ExpertDeps, expert_cache, lookup_expert, query_expert, system_prompt
+from Law_agent_Endpoint import AgentRequest, AgentResponse, sse_event
+from Law_agent_history import select_history
+from Law_agent_storage import dump_messages, history_to_messages
+
+ROOT = Path(__file__).parent.parent
+HISTORY_SIZES = (10, 50)
+ANSWER_CHARS = {"short": 300, "long": 3000}
+EXPERT_CHARS = 4000
+ARABIC = "تمر التصفية الإدارية بثلاث مراحل تبدأ بافتتاح الإجراء ثم حصر أصول المدين وبيعها وتوزيع العائدات. "
+
+
+def text(chars: int) -> str:
+    return (ARABIC * (chars // len(ARABIC) + 1))[:chars]
+
+
+# --- Fixtures ---
+def run_messages(answer_chars: int) -> list:
+    """The new messages of one tool-calling run, as the agent produces them."""
+    now = datetime.now(timezone.utc)
+    return [
+        ModelRequest(parts=[UserPromptPart(content="ما هي إجراءات التصفية الإدارية؟", timestamp=now)],
+                     instructions=system_prompt),
+        ModelResponse(parts=[ToolCallPart(tool_name="expert", args={"query": "إجراءات التصفية الإدارية"},
+                                          tool_call_id="call_1")], model_name="openai/gpt-4o-mini", timestamp=now),
+        ModelRequest(parts=[ToolReturnPart(tool_name="expert", content=text(EXPERT_CHARS),
+                                           tool_call_id="call_1", timestamp=now)], instructions=system_prompt),
+        ModelResponse(parts=[TextPart(content=text(answer_chars))], model_name="openai/gpt-4o-mini", timestamp=now),
+    ]
+
+
+def history_rows(count: int) -> List[Dict[str, Any]]:
+    """`count` stored rows alternating a human message and a complete stored turn."""
+    start = datetime.now(timezone.utc) - timedelta(hours=1)
+    stored = dump_messages(run_messages(ANSWER_CHARS["short"]))
+    rows = []
+    for i in range(count):
+        if i % 2 == 0:
+            message = {"type": "human", "content": "ما هي إجراءات التصفية الإدارية؟"}
+        else:
+            message = {"type": "ai", "content": text(ANSWER_CHARS["short"]), "data": {"messages": stored}}
+        rows.append({"session_id": "bench", "message": message, "created_at": (start + timedelta(seconds=i)).isoformat()})
+    return rows
+
+
+def request_body() -> bytes:
+    return json.dumps({
+        "query": "ما هي إجراءات التصفية الإدارية؟",
+        "user_id": "bench-user",
+        "request_id": "0b5f3f4e-8f0e-4c52-9d7c-7d7a3f1c2b11",
+        "session_id": "5e0f5a36-2a6c-4f8d-9f4f-0e3b1f0d9c21",
+    }, ensure_ascii=False).encode()
+
+
+def expert_deps() -> ExpertDeps:
+    body = json.dumps({"response": text(EXPERT_CHARS)}, ensure_ascii=False).encode()
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body))
+    return ExpertDeps(client=httpx.AsyncClient(transport=transport), expert_api_key="bench")
+
+
+def stored_row(answer_chars: int) -> Dict[str, Any]:
+    data = {"request_id": "bench", "messages": dump_messages(run_messages(answer_chars))}
+    return {"session_id": "bench", "message": {"type": "ai", "content": text(answer_chars), "data": data},
+            "created_at": datetime.now(timezone.utc).isoformat()}
+
+
+# --- Benchmarks ---
+def benchmarks() -> Dict[str, tuple[str, Dict[str, Any], Callable[[], Any]]]:
+    """name -> (group, params, function); coroutine functions are awaited."""
+    cases = {}
+    for size in HISTORY_SIZES:
+        rows = history_rows(size)
+        messages = history_to_messages(rows)
+        cases[f"history_to_messages[{size}]"] = ("history", {"rows": size}, lambda rows=rows: history_to_messages(rows))
+        cases[f"select_history[{size}]"] = ("history", {"rows": size}, lambda messages=messages: select_history(messages))
+
+    body = request_body()
+    cases["agent_request_validate_json"] = ("request", {}, lambda: AgentRequest.model_validate_json(body))
+
+    deps = expert_deps()
+    query = "إجراءات التصفية الإدارية"
+    expert_cache.set(query, text(EXPERT_CHARS))
+
+    async def run_query_expert():
+        return await query_expert(deps, query)
+
+    async def run_lookup_expert():
+        return await lookup_expert(deps, query)
+
+    cases["query_expert"] = ("expert", {"response_chars": EXPERT_CHARS}, run_query_expert)
+    cases["lookup_expert_cache_hit"] = ("expert", {}, run_lookup_expert)
+
+    for label, chars in ANSWER_CHARS.items():
+        messages = run_messages(chars)
+        row = stored_row(chars)
+        cases[f"dump_messages[{label}]"] = ("encode", {"answer_chars": chars}, lambda messages=messages: dump_messages(messages))
+        cases[f"stored_row_json[{label}]"] = ("encode", {"answer_chars": chars},
+                                              lambda row=row: json.dumps(row, ensure_ascii=False))
+    response = AgentResponse(success=True, timings={"history_fetch": 12.5, "agent_run": 2100.0, "total": 2130.2},
+                             history_tokens=1800, prompt_tokens=5200, cached_tokens=4096)
+    cases["agent_response_json"] = ("encode", {}, response.model_dump_json)
+    cases["sse_token_event"] = ("encode", {}, lambda: sse_event("token", {"delta": "التصفية الإدارية "}))
+    return cases
+
+
+def timed(function, iterations: int, loop: asyncio.AbstractEventLoop) -> float:
+    """Seconds for `iterations` calls; coroutines are awaited inside one loop run."""
+    if asyncio.iscoroutinefunction(function):
+        async def run():
+            start = time.perf_counter()
+            for _ in range(iterations):
+                await function()
+            return time.perf_counter() - start
+        return loop.run_until_complete(run())
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return time.perf_counter() - start
+
+
+def measure(function, rounds: int, min_round: float, loop: asyncio.AbstractEventLoop) -> tuple[List[float], int]:
+    """Per-call seconds for each round, and the calls per round."""
+    # One untimed call first, so lazy initialization (e.g. the tokenizer) does not skew calibration.
+    timed(function, 1, loop)
+    iterations = 1
+    while timed(function, iterations, loop) < min_round and iterations < 1_000_000:
+        iterations *= 2
+    return [timed(function, iterations, loop) / iterations for _ in range(rounds)], iterations
+
+
+def stats(samples: List[float]) -> Dict[str, float]:
+    q1, median, q3 = statistics.quantiles(samples, n=4) if len(samples) > 1 else (samples[0],) * 3
+    mean = statistics.fmean(samples)
+    return {
+        "min": min(samples),
+        "max": max(samples),
+        "mean": mean,
+        "stddev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "rounds": len(samples),
+        "median": statistics.median(samples),
+        "iqr": q3 - q1,
+        "q1": q1,
+        "q3": q3,
+        "ops": 1 / mean,
+    }
+
+
+def commit_info() -> Dict[str, Any]:
+    def git(*args: str) -> str:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return {"id": git("rev-parse", "HEAD"), "branch": git("rev-parse", "--abbrev-ref", "HEAD"),
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def compare(current: Dict[str, Any], baseline_path: str, fail_above: Optional[float]) -> bool:
+    """Print the median change per benchmark; returns False when one regressed past `fail_above`."""
+    baseline = {b["name"]: b["stats"] for b in json.loads(Path(baseline_path).read_text())["benchmarks"]}
+    ok = True
+    print(f"\n{'benchmark':<34} | {'before us':>10} | {'after us':>10} | {'change':>8}")
+    print("-" * 72)
+    for bench in current["benchmarks"]:
+        before = baseline.get(bench["name"])
+        after_us = bench["stats"]["median"] * 1e6
+        if before is None:
+            print(f"{bench['name']:<34} | {'-':>10} | {after_us:>10.1f} | {'new':>8}")
+            continue
+        change = (bench["stats"]["median"] / before["median"] - 1) * 100
+        flag = ""
+        if fail_above is not None and change > fail_above:
+            ok, flag = False, "  <- regression"
+        print(f"{bench['name']:<34} | {before['median'] * 1e6:>10.1f} | {after_us:>10.1f} | {change:>+7.1f}%{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=15)
+    parser.add_argument("--min-round-ms", type=float, default=20)
+    parser.add_argument("--filter", help="only benchmarks whose name or group contains this")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    parser.add_argument("--fail-above", type=float, help="exit 1 if a median is this many percent slower")
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    results = []
+    print(f"{'benchmark':<34} | {'median us':>10} | {'iqr us':>8} | {'ops/s':>10} | {'calls':>7}")
+    print("-" * 80)
+    for name, (group, params, function) in benchmarks().items():
+        if args.filter and args.filter not in name and args.filter != group:
+            continue
+        samples, iterations = measure(function, args.rounds, args.min_round_ms / 1000, loop)
+        s = stats(samples)
+        print(f"{name:<34} | {s['median'] * 1e6:>10.1f} | {s['iqr'] * 1e6:>8.1f} | {s['ops']:>10.0f} | {iterations:>7}")
+        results.append({
+            "group": group,
+            "name": name,
+            "fullname": f"benchmarks/bench_hot_paths.py::{name}",
+            "params": params or None,
+            "param": None,
+            "extra_info": {},
+            "options": {"min_rounds": args.rounds, "min_time": args.min_round_ms / 1000, "timer": "perf_counter"},
+            "stats": s,
+        })
+
+    output = {
+        "machine_info": {"node": platform.node(), "processor": platform.processor(), "machine": platform.machine(),
+                         "python_version": platform.python_version(),
+                         "python_implementation": platform.python_implementation()},
+        "commit_info": commit_info(),
+        "benchmarks": results,
+        "datetime": datetime.now(timezone.utc).isoformat(),
+        "version": "bench_hot_paths",
+    }
+    if args.save:
+        Path(args.save).write_text(json.dumps(output, indent=2))
+    if args.compare and not compare(output, args.compare, args.fail_above):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+End-to-end latency and token usage: tool-calling flow vs retrieve-first mode.
+
+- tool_calling:   expert_agent decides to call `expert` (LLM -> tool -> LLM).
+- retrieve_first: the question is sent to the retrieval endpoint up front and the
+                  result is answered by answer_agent in a single generation call.
+
+The expert result cache is cleared before every run so both modes pay for a cold
+retrieval. Needs the same environment as the agent (model key, EXPERT_API_KEY).
+
+Usage:
+    python benchmarks/bench_pipeline_modes.py --rounds 3
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to Python path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from Law_agent import (
+    ExpertDeps,
+    answer_agent,
+    build_retrieve_first_prompt,
+    create_expert_client,
+    expert_agent,
+    expert_cache,
+)
+from Law_agent_metrics import run_usage
+
+QUESTIONS = [
+    "ما هي إجراءات التصفية الإدارية؟",
+    "كيف يتم ترتيب الدائنين عند توزيع أموال التفليسة؟",
+    "ما الفرق بين التسوية الوقائية وإعادة التنظيم المالي؟",
+    "من يحق له طلب افتتاح إجراء التصفية؟",
+]
+
+
+async def run_once(deps: ExpertDeps, question: str, mode: str) -> dict:
+    expert_cache.cache.clear()
+    start = time.perf_counter()
+    if mode == "retrieve_first":
+        prompt = await build_retrieve_first_prompt(deps, question)
+        result = await answer_agent.run(prompt, deps=deps)
+    else:
+        result = await expert_agent.run(question, deps=deps)
+    usage = run_usage(result)
+    return {
+        "latency_ms": (time.perf_counter() - start) * 1000,
+        "requests": usage.requests,
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    results: dict[str, list[dict]] = {"tool_calling": [], "retrieve_first": []}
+    async with create_expert_client() as client:
+        deps = ExpertDeps(client=client, expert_api_key=os.getenv("EXPERT_API_KEY"))
+        for _ in range(args.rounds):
+            for question in QUESTIONS:
+                # Alternate modes so upstream drift affects both equally.
+                for mode in results:
+                    results[mode].append(await run_once(deps, question, mode))
+
+    print(f"{len(QUESTIONS) * args.rounds} questions per mode")
+    print(f"{'mode':<15} | {'p50 ms':>8} | {'mean ms':>8} | {'LLM requests':>12} | {'input tok':>9} | {'output tok':>10}")
+    print("-" * 78)
+    for mode, runs in results.items():
+        latencies = [run["latency_ms"] for run in runs]
+        print(f"{mode:<15} | {statistics.median(latencies):>8.0f} | {statistics.mean(latencies):>8.0f} | "
+              f"{statistics.mean(run['requests'] for run in runs):>12.2f} | "
+              f"{statistics.mean(run['input_tokens'] for run in runs):>9.0f} | "
+              f"{statistics.mean(run['output_tokens'] for run in runs):>10.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
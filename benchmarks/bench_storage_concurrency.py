@@ -0,0 +1,93 @@
+"""
+Concurrency benchmark for the Supabase persistence layer.
+
+Runs N concurrent sessions, each doing the per-turn database work of the
+endpoint (one history fetch plus two message inserts), and reports the
+throughput at every concurrency level. Two backends are compared:
+
+- blocking: every round trip holds the event loop, like the old sync client.
+- async:    every round trip is awaited, like the async client in use now.
+
+With the blocking backend throughput stays flat as sessions are added; with
+the async backend it scales until the database itself becomes the bottleneck.
+
+Usage:
+    python benchmarks/bench_storage_concurrency.py --latency-ms 40 --turns 5
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+# Add parent directory to Python path
+sys.path.append(str(Path(__file__).parent.parent))
+
+import Law_agent_storage
+from Law_agent_storage import fetch_conversation_history, store_message
+
+
+class _SimulatedQuery:
+    """Fluent stand-in for a postgrest query builder with a fixed round-trip latency."""
+
+    def __init__(self, latency: float, blocking: bool):
+        self.latency = latency
+        self.blocking = blocking
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    async def execute(self):
+        if self.blocking:
+            time.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+        return SimpleNamespace(data=[])
+
+
+class _SimulatedSupabase:
+    def __init__(self, latency: float, blocking: bool):
+        self.latency = latency
+        self.blocking = blocking
+
+    def table(self, name: str) -> _SimulatedQuery:
+        return _SimulatedQuery(self.latency, self.blocking)
+
+
+async def _session(session_id: str, turns: int):
+    for _ in range(turns):
+        await fetch_conversation_history(session_id)
+        await store_message(session_id, "human", "ما هي إجراءات التصفية الإدارية؟")
+        await store_message(session_id, "ai", "...", data={"request_id": "bench"})
+
+
+async def _measure(concurrency: int, turns: int) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(_session(f"bench-{i}", turns) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return concurrency * turns / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=40.0, help="Simulated database round trip.")
+    parser.add_argument("--turns", type=int, default=5, help="Turns per session.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    print(f"{'sessions':>8} | {'blocking turns/s':>16} | {'async turns/s':>13} | {'speedup':>7}")
+    print("-" * 54)
+    for concurrency in args.concurrency:
+        Law_agent_storage._supabase = _SimulatedSupabase(latency, blocking=True)
+        blocking = await _measure(concurrency, args.turns)
+        Law_agent_storage._supabase = _SimulatedSupabase(latency, blocking=False)
+        non_blocking = await _measure(concurrency, args.turns)
+        print(f"{concurrency:>8} | {blocking:>16.1f} | {non_blocking:>13.1f} | {non_blocking / blocking:>6.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
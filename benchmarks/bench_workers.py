@@ -0,0 +1,61 @@
+"""
+Throughput of the production server at 1, 2, 4 and 8 workers.
+
+Uses the load_test.py harness: starts benchmarks/fake_upstream.py as the model, expert
+and Supabase backends, then for each worker count launches
+`gunicorn -c gunicorn.conf.py Law_agent_Endpoint:app` and drives POST /api/pydantic-Law-agent with a fixed number of concurrent clients.
+Every request is a fresh in-scope question with caches off, so each one goes through
+two model calls and one expert call. Reports requests/second and latency percentiles.
+
+Usage:
+    python benchmarks/bench_workers.py --workers 1 2 4 8 --concurrency 64 --duration 20
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import os
+
+from load_test import drive, server_env, start_server, start_upstream, wait_ready
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--llm-latency", default="50")
+    parser.add_argument("--port", type=int, default=8101)
+    parser.add_argument("--upstream-port", type=int, default=9101)
+    args = parser.parse_args()
+
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    upstream = start_upstream(args.upstream_port, args.llm_latency)
+    env = server_env(upstream_url, args.port)
+
+    results = {}
+    try:
+        await wait_ready(f"{upstream_url}/rest/v1/messages")
+        for workers in args.workers:
+            server = start_server(env, workers)
+            try:
+                base = f"http://127.0.0.1:{args.port}/api/pydantic-Law-agent"
+                await wait_ready(f"{base}/stats")
+                results[workers] = await drive(base, args.concurrency, args.duration)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    print(f"{args.concurrency} concurrent clients, {args.duration:.0f}s per run, "
+          f"model latency {args.llm_latency} ms, {os.cpu_count()} CPUs")
+    print(f"{'workers':>7} | {'req/s':>8} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | {'failed':>6}")
+    print("-" * 60)
+    for workers, r in results.items():
+        print(f"{workers:>7} | {r['rps']:>8.1f} | {r['p50']:>8.0f} | {r['p95']:>8.0f} | {r['p99']:>8.0f} | {r['failures']:>6}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
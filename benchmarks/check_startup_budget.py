@@ -0,0 +1,119 @@
+"""
+Import-time and startup-time budget for the endpoint; exits 1 when it regresses.
+
+Each measurement runs in a fresh interpreter:
+
+- import:   `import Law_agent_Endpoint`, which must stay cheap because every worker
+            spawn and every CLI or benchmark run pays it.
+- startup:  import plus the lifespan hook (warm-up, HTTP pool, Supabase client), i.e.
+            the time until the app can serve its first request.
+
+It also fails if importing the endpoint pulls in a module that should only load on
+first use (devtools, the OpenAI SDK, supabase). On failure the slowest top-level
+imports from `python -X importtime` are listed.
+
+Usage:
+    python benchmarks/check_startup_budget.py --import-budget-ms 1500 --startup-budget-ms 3000
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+# Modules that must not be imported by `import Law_agent_Endpoint`.
+DEFERRED_MODULES = ("devtools", "openai", "supabase")
+
+IMPORT_SNIPPET = """
+import sys, time
+start = time.perf_counter()
+import Law_agent_Endpoint
+loaded = ",".join(m for m in {deferred!r} if m in sys.modules)
+print("BUDGET", (time.perf_counter() - start) * 1000, loaded)
+"""
+
+STARTUP_SNIPPET = """
+import asyncio, time
+start = time.perf_counter()
+import Law_agent_Endpoint
+
+async def main():
+    app = Law_agent_Endpoint.app
+    async with app.router.lifespan_context(app):
+        print("BUDGET", (time.perf_counter() - start) * 1000)
+
+asyncio.run(main())
+"""
+
+
+def run_python(code: str, *flags: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def median_ms(code: str, runs: int) -> tuple[float, str]:
+    """Median milliseconds over `runs` interpreters, plus the deferred modules found loaded."""
+    samples, loaded = [], ""
+    for _ in range(runs):
+        # The app may print its own messages; the measurement is on the BUDGET line.
+        line = next(line for line in run_python(code).stdout.splitlines() if line.startswith("BUDGET"))
+        fields = line.split()
+        samples.append(float(fields[1]))
+        loaded = fields[2] if len(fields) > 2 else ""
+    return statistics.median(samples), loaded
+
+
+def slowest_imports(limit: int = 10) -> list[tuple[int, str]]:
+    """Top-level imports by cumulative microseconds, from -X importtime."""
+    stderr = run_python("import Law_agent_Endpoint", "-X", "importtime").stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented by two more spaces per level.
+        if cumulative.strip().isdigit() and len(name) - len(name.lstrip()) == 1:
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--import-budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", "1500")))
+    parser.add_argument("--startup-budget-ms", type=float, default=float(os.getenv("STARTUP_BUDGET_MS", "3000")))
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    import_ms, loaded = median_ms(IMPORT_SNIPPET.format(deferred=DEFERRED_MODULES), args.runs)
+    startup_ms, _ = median_ms(STARTUP_SNIPPET, args.runs)
+
+    failures = []
+    if import_ms > args.import_budget_ms:
+        failures.append(f"import took {import_ms:.0f} ms (budget {args.import_budget_ms:.0f} ms)")
+    if startup_ms > args.startup_budget_ms:
+        failures.append(f"startup took {startup_ms:.0f} ms (budget {args.startup_budget_ms:.0f} ms)")
+    if loaded:
+        failures.append(f"import loaded modules that should be deferred: {loaded}")
+
+    print(f"import  {import_ms:>7.0f} ms  (budget {args.import_budget_ms:.0f} ms)")
+    print(f"startup {startup_ms:>7.0f} ms  (budget {args.startup_budget_ms:.0f} ms)")
+    if failures:
+        print("\nFAILED:\n  " + "\n  ".join(failures))
+        print("\nSlowest top-level imports (cumulative):")
+        for micros, name in slowest_imports():
+            print(f"  {micros / 1000:>8.1f} ms  {name}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Fake upstream services for driving the endpoint without real dependencies.
+
+Serves, from one process:
+
+- POST /v1/chat/completions  OpenAI-compatible model: calls the `expert` tool on a
+                             fresh question, then answers once the tool result is in.
+                             Honours `stream: true` with SSE chunks, including the
+                             tool call and the final usage chunk.
+- POST /query                the LightRAG expert endpoint.
+- /rest/v1/{table}           a PostgREST stand-in for Supabase: rows are kept in memory
+                             and selects apply eq/lt/gt filters, order and limit, so
+                             follow-up turns see their session history.
+
+Latencies are distributions, given as `MS`, `uniform:LOW,HIGH`, `normal:MEAN,STDDEV`,
+`lognormal:MEDIAN,SIGMA` or `exp:MEAN` (all in milliseconds). The model latency is the
+time to the first byte; streamed answers then wait `--token-latency` between chunks.
+
+Point the agent at it with OPENAI_BASE_URL=http://host:port/v1, OPENAI_API_KEY=fake,
+EXPERT_API_URL=http://host:port/query, EXPERT_API_KEY=fake, SUPABASE_URL=http://host:port
+and SUPABASE_SERVICE_KEY=fake.fake.fake.
+
+Usage:
+    python benchmarks/fake_upstream.py --port 9101 --llm-latency lognormal:400,0.5 --token-latency 15
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import re
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EXPERT_TEXT = (
+    "تمر التصفية الإدارية بثلاث مراحل: افتتاح الإجراء بقرار من المحكمة، ثم حصر أصول المدين "
+    "وتقييمها بواسطة أمين الإفلاس، ثم بيع الأصول وتوزيع العائدات على الدائنين وفق مراتب ديونهم."
+)
+ANSWER_TEXT = "بحسب قاعدة بياناتنا القانونية، " + EXPERT_TEXT
+
+
+class Latency:
+    """A latency distribution parsed from `MS` or `KIND:PARAMS`; samples are in seconds."""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, params = spec.partition(":") if ":" in spec else ("fixed", "", spec)
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",")]
+        if self.kind not in ("fixed", "uniform", "normal", "lognormal", "exp"):
+            raise ValueError(f"Unknown latency distribution {spec!r}")
+
+    def sample(self) -> float:
+        p = self.params
+        if self.kind == "fixed":
+            ms = p[0]
+        elif self.kind == "uniform":
+            ms = random.uniform(p[0], p[1])
+        elif self.kind == "normal":
+            ms = random.gauss(p[0], p[1])
+        elif self.kind == "lognormal":
+            ms = random.lognormvariate(math.log(p[0]), p[1])
+        else:
+            ms = random.expovariate(1 / p[0])
+        return max(ms, 0) / 1000
+
+    async def wait(self):
+        delay = self.sample()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+app = FastAPI()
+app.state.llm_latency = Latency("50")
+app.state.token_latency = Latency("0")
+app.state.expert_latency = Latency("20")
+# table -> session_id -> rows; every table the agent uses is keyed by session.
+app.state.tables = defaultdict(lambda: defaultdict(list))
+app.state.row_ids = itertools.count(1)
+
+
+# --- Model ---
+def _usage(body: dict, message: dict) -> dict:
+    prompt_tokens = sum(len(str(m.get("content") or "")) for m in body.get("messages", [])) // 3
+    completion_tokens = len(str(message.get("content") or message.get("tool_calls"))) // 3
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _reply(body: dict) -> tuple[dict, str]:
+    """The assistant message for this turn and its finish reason."""
+    last = body["messages"][-1]
+    if body.get("tools") and last["role"] == "user":
+        call = {
+            "id": "call_fake",
+            "type": "function",
+            "function": {"name": "expert", "arguments": json.dumps({"query": last["content"]}, ensure_ascii=False)},
+        }
+        return {"role": "assistant", "content": None, "tool_calls": [call]}, "tool_calls"
+    return {"role": "assistant", "content": ANSWER_TEXT}, "stop"
+
+
+def _chunk(body: dict, delta: dict, finish_reason: Optional[str] = None) -> str:
+    chunk = {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+async def _stream(body: dict, message: dict, finish_reason: str):
+    yield _chunk(body, {"role": "assistant", "content": ""})
+    if message.get("tool_calls"):
+        calls = [dict(call, index=i) for i, call in enumerate(message["tool_calls"])]
+        yield _chunk(body, {"tool_calls": calls})
+    else:
+        # One chunk per word, roughly what a provider sends for Arabic text.
+        for token in re.findall(r"\S+\s*", message["content"]):
+            await app.state.token_latency.wait()
+            yield _chunk(body, {"content": token})
+    yield _chunk(body, {}, finish_reason)
+    if (body.get("stream_options") or {}).get("include_usage"):
+        usage = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                 "model": body.get("model", "fake"), "choices": [], "usage": _usage(body, message)}
+        yield f"data: {json.dumps(usage)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await app.state.llm_latency.wait()
+    message, finish_reason = _reply(body)
+    if body.get("stream"):
+        return StreamingResponse(_stream(body, message, finish_reason), media_type="text/event-stream")
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": _usage(body, message),
+    }
+
+
+# --- Expert ---
+@app.post("/query")
+async def query():
+    await app.state.expert_latency.wait()
+    return {"response": EXPERT_TEXT}
+
+
+# --- PostgREST ---
+def _matches(row: Dict[str, Any], column: str, condition: str) -> bool:
+    op, _, value = condition.partition(".")
+    cell = str(row.get(column))
+    if op == "eq":
+        return cell == value
+    if op == "lt":
+        return cell < value
+    if op == "gt":
+        return cell > value
+    return True
+
+
+@app.get("/rest/v1/{table}")
+async def select_rows(table: str, request: Request):
+    params = request.query_params
+    filters = [(k, v) for k, v in params.multi_items() if k not in ("select", "order", "limit", "offset")]
+    session = next((v[3:] for k, v in filters if k == "session_id" and v.startswith("eq.")), None)
+    buckets = app.state.tables[table]
+    rows: List[Dict[str, Any]] = buckets.get(session, []) if session is not None else [r for b in buckets.values() for r in b]
+    rows = [row for row in rows if all(_matches(row, k, v) for k, v in filters)]
+
+    # `order=a.desc,b` sorts by b first so a stays the primary key.
+    terms = [term for value in params.getlist("order") for term in value.split(",") if term]
+    for term in reversed(terms):
+        column, *modifiers = term.split(".")
+        rows = sorted(rows, key=lambda row: str(row.get(column)), reverse="desc" in modifiers)
+    if "limit" in params:
+        rows = rows[:int(params["limit"])]
+
+    columns = params.get("select", "*")
+    if columns != "*":
+        names = [name.strip() for name in columns.split(",")]
+        rows = [{name: row.get(name) for name in names} for row in rows]
+    return rows
+
+
+@app.post("/rest/v1/{table}")
+async def insert_rows(table: str, request: Request):
+    body = await request.json()
+    rows = body if isinstance(body, list) else [body]
+    buckets = app.state.tables[table]
+    conflict = request.query_params.get("on_conflict") if "merge-duplicates" in request.headers.get("prefer", "") else None
+    for row in rows:
+        bucket = buckets[row.get("session_id")]
+        if conflict:
+            bucket[:] = [old for old in bucket if old.get(conflict) != row.get(conflict)]
+        row.setdefault("id", next(app.state.row_ids))
+        bucket.append(row)
+    return JSONResponse(rows, status_code=201)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9101)
+    parser.add_argument("--llm-latency", default="50", help="time to first byte of a model call")
+    parser.add_argument("--token-latency", default="0", help="delay between streamed chunks")
+    parser.add_argument("--expert-latency", default="20")
+    args = parser.parse_args()
+    app.state.llm_latency = Latency(args.llm_latency)
+    app.state.token_latency = Latency(args.token_latency)
+    app.state.expert_latency = Latency(args.expert_latency)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
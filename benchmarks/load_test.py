@@ -0,0 +1,209 @@
+"""
+Offline load test of /api/pydantic-Law-agent against local stand-ins.
+
+Starts benchmarks/fake_upstream.py in place of OpenRouter, the LightRAG /query host and
+Supabase, launches the production server (`gunicorn -c gunicorn.conf.py`) pointed at it,
+then keeps `--concurrency` clients sending questions for `--duration` seconds. Each
+client asks `--turns` questions per session, so later turns load and replay history.
+Caches, rate limiting and admission control are off so every request does the full
+work; no real tokens are spent.
+
+Reports requests/second and p50/p95/p99 latency, plus time to first token for the
+streaming endpoint. `--url` drives an already running server instead.
+
+Usage:
+    python benchmarks/load_test.py --concurrency 32 --duration 30 --llm-latency lognormal:400,0.5
+    python benchmarks/load_test.py --mode stream --token-latency 15 --workers 4
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = Path(__file__).parent.parent
+API_TOKEN = "load-test"
+QUESTIONS = [
+    "ما هي إجراءات التصفية الإدارية؟",
+    "كيف يتم ترتيب الدائنين في التفليسة؟",
+    "ما هي شروط التسوية الوقائية؟",
+    "من يعين أمين الإفلاس؟",
+]
+
+
+def start_upstream(port: int, llm_latency: str, token_latency: str = "0", expert_latency: str = "20") -> subprocess.Popen:
+    return subprocess.Popen([
+        sys.executable, str(ROOT / "benchmarks" / "fake_upstream.py"), "--port", str(port),
+        "--llm-latency", llm_latency, "--token-latency", token_latency, "--expert-latency", expert_latency,
+    ])
+
+
+def server_env(upstream_url: str, port: int) -> Dict[str, str]:
+    """Environment pointing the server at the stand-ins, with caches and limits off."""
+    return os.environ | {
+        "PORT": str(port),
+        "API_BEARER_TOKEN": API_TOKEN,
+        "OPEN_ROUTER_API_KEY": "",
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": f"{upstream_url}/v1",
+        "EXPERT_API_URL": f"{upstream_url}/query",
+        "EXPERT_API_KEY": "fake",
+        "SUPABASE_URL": upstream_url,
+        "SUPABASE_SERVICE_KEY": "fake.fake.fake",
+        "EXPERT_CACHE_MAX_BYTES": "0",
+        "ANSWER_CACHE_MAX_ENTRIES": "0",
+        "SUMMARY_TRIGGER_TOKENS": "0",
+        "RATE_LIMIT_PER_MINUTE": "0",
+        "AGENT_MAX_CONCURRENCY": "0",
+    }
+
+
+def start_server(env: Dict[str, str], workers: int) -> subprocess.Popen:
+    return subprocess.Popen(
+        ["gunicorn", "-c", "gunicorn.conf.py", "Law_agent_Endpoint:app"],
+        cwd=ROOT,
+        env=env | {"WEB_CONCURRENCY": str(workers)},
+    )
+
+
+async def wait_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def _blocking(client: httpx.AsyncClient, url: str, body: dict) -> tuple[bool, Optional[float]]:
+    response = await client.post(url, json=body)
+    return response.status_code == 200 and response.json().get("success"), None
+
+
+async def _stream(client: httpx.AsyncClient, url: str, body: dict) -> tuple[bool, Optional[float]]:
+    """Read the SSE response to the end; returns success and time to the first token event."""
+    start = time.perf_counter()
+    ttft_ms, done = None, False
+    async with client.stream("POST", f"{url}/stream", json=body) as response:
+        async for line in response.aiter_lines():
+            if line == "event: token" and ttft_ms is None:
+                ttft_ms = (time.perf_counter() - start) * 1000
+            done = done or line == "event: done"
+    return response.status_code == 200 and done, ttft_ms
+
+
+async def drive(url: str, concurrency: int, duration: float, mode: str = "blocking", turns: int = 1,
+                token: str = API_TOKEN) -> dict:
+    """Closed-loop load: each client sends its next request as soon as the previous one returns."""
+    send = _stream if mode == "stream" else _blocking
+    latencies: List[float] = []
+    ttfts: List[float] = []
+    failures = 0
+    deadline = time.monotonic() + duration
+
+    async def client_loop(client: httpx.AsyncClient, index: int):
+        nonlocal failures
+        i = index
+        while time.monotonic() < deadline:
+            if (i - index) % turns == 0:
+                session_id = str(uuid.uuid4())
+            body = {
+                "query": QUESTIONS[i % len(QUESTIONS)],
+                "user_id": f"load-{index}",
+                "request_id": str(uuid.uuid4()),
+                "session_id": session_id,
+                "new_session": (i - index) % turns == 0,
+            }
+            start = time.perf_counter()
+            try:
+                ok, ttft_ms = await send(client, url, body)
+            except (httpx.HTTPError, ValueError):
+                ok, ttft_ms = False, None
+            if ok:
+                latencies.append((time.perf_counter() - start) * 1000)
+                if ttft_ms is not None:
+                    ttfts.append(ttft_ms)
+            else:
+                failures += 1
+            i += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    headers = {"Authorization": f"Bearer {token}"}
+    async with httpx.AsyncClient(limits=limits, timeout=120, headers=headers) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client, index) for index in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    result = {"rps": len(latencies) / elapsed, "requests": len(latencies), "failures": failures}
+    result.update({f"p{q}": percentile(latencies, q / 100) for q in (50, 95, 99)})
+    if ttfts:
+        result.update({f"ttft_p{q}": percentile(ttfts, q / 100) for q in (50, 95, 99)})
+    return result
+
+
+def print_result(r: dict):
+    print(f"requests {r['requests']}, failed {r['failures']}, {r['rps']:.1f} req/s")
+    print(f"latency  p50 {r['p50']:.0f} ms  p95 {r['p95']:.0f} ms  p99 {r['p99']:.0f} ms")
+    if "ttft_p50" in r:
+        print(f"ttft     p50 {r['ttft_p50']:.0f} ms  p95 {r['ttft_p95']:.0f} ms  p99 {r['ttft_p99']:.0f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["blocking", "stream"], default="blocking")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--turns", type=int, default=3, help="questions per session")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--llm-latency", default="lognormal:400,0.5")
+    parser.add_argument("--token-latency", default="15")
+    parser.add_argument("--expert-latency", default="lognormal:800,0.4")
+    parser.add_argument("--port", type=int, default=8101)
+    parser.add_argument("--upstream-port", type=int, default=9101)
+    parser.add_argument("--url", help="drive this running server instead of starting one")
+    parser.add_argument("--token", default=os.getenv("API_BEARER_TOKEN", API_TOKEN))
+    args = parser.parse_args()
+
+    print(f"{args.mode}, {args.concurrency} concurrent clients, {args.turns} turns per session, {args.duration:.0f}s")
+    if args.url:
+        print_result(await drive(args.url, args.concurrency, args.duration, args.mode, args.turns, args.token))
+        return
+
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    upstream = start_upstream(args.upstream_port, args.llm_latency, args.token_latency, args.expert_latency)
+    try:
+        await wait_ready(f"{upstream_url}/rest/v1/messages")
+        server = start_server(server_env(upstream_url, args.port), args.workers)
+        try:
+            url = f"http://127.0.0.1:{args.port}/api/pydantic-Law-agent"
+            await wait_ready(f"{url}/stats")
+            print(f"{args.workers} workers, model {args.llm_latency} ms, expert {args.expert_latency} ms")
+            print_result(await drive(url, args.concurrency, args.duration, args.mode, args.turns))
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
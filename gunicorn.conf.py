@@ -0,0 +1,76 @@
+"""
+Production server settings.
+
+    gunicorn -c gunicorn.conf.py Law_agent_Endpoint:app
+
+Runs WEB_CONCURRENCY uvicorn workers (2 by default) behind a gunicorn master. Set the worker count through WEB_CONCURRENCY rather than --workers, so the
+multi-worker defaults below see it. `python Law_agent_Endpoint.py` still starts
+a single development process.
+"""
+import os
+import shutil
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8001')}"
+# A small fixed default: in a container cpu_count() reports the host's cores, not the CPU
+# quota, and every worker holds its own caches and connection pools.
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Optimization: Import the app once in the master and fork the workers from it, so the
+# scope model, tokenizer tables and compiled modules are shared copy-on-write and a
+# worker restart does not pay the import cost again. Everything holding sockets or an
+# event loop (HTTP pool, Supabase client, message writer) is created per worker in the
+# lifespan hook or on first use, never at import.
+preload_app = True
+
+# Seconds an idle client connection is kept open; keep above the load balancer's idle timeout.
+keepalive = int(os.getenv("KEEPALIVE", "75"))
+# A worker silent for this long is killed; must exceed the slowest agent run.
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+# Time a stopping worker gets to finish in-flight requests and flush the message writer.
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+# Recycle workers after this many requests (0 disables) to cap slow memory growth.
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+
+# Process-local state with several workers: consecutive requests of one session can land
+# on different workers, so a session cache would miss the turns another worker stored and
+# serve stale history. It is off unless SESSION_CACHE_MAX_SESSIONS is set explicitly, which
+# is only safe when each session is pinned to a single process. The expert and answer
+# caches hold session-independent results and stay on per worker.
+#
+# Prometheus metrics are per process too; in multiprocess mode each worker writes its
+# samples to PROMETHEUS_MULTIPROC_DIR and /metrics aggregates all of them. It has to be set
+# here, before the preloaded app imports prometheus_client.
+if workers > 1:
+    os.environ.setdefault("SESSION_CACHE_MAX_SESSIONS", "0")
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/law-agent-metrics")
+
+# The preloaded app opens its metric files in the master as soon as it is imported, which
+# happens before any server hook runs, so the directory is emptied (samples of a previous
+# run would be summed in) and created while this file is loaded.
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of a worker that exited."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    """Warm lazily loaded tables in the master so every forked worker inherits them."""
+    from Law_agent_Endpoint import warm_up
+
+    warm_up()
+    from Law_agent_ratelimit import RATE_LIMIT_BACKEND, RATE_LIMIT_PER_MINUTE
+
+    if workers > 1 and RATE_LIMIT_PER_MINUTE > 0 and RATE_LIMIT_BACKEND == "memory":
+        server.log.warning(
+            "RATE_LIMIT_BACKEND=memory keeps one bucket per worker: users get up to %d times "
+            "RATE_LIMIT_PER_MINUTE. Use RATE_LIMIT_BACKEND=redis to share the limit.", workers
+        )